@@ -1,8 +1,9 @@
 #! /usr/bin/env python3
 # coding: utf-8
 import argparse
-import sys
+import json
 import typing as t
+from pathlib import Path
 
 import dropbox
 import rq
@@ -10,7 +11,15 @@ from gunicorn.app.base import BaseApplication
 
 from kamera import config, server
 from kamera.logger import log
-from kamera.task import Task
+from kamera.retry import RetryingDropbox
+from kamera.task import (
+    Task,
+    Transfer,
+    TransferBatcher,
+    run_pipeline,
+    seconds_in_fortnight,
+)
+from kamera.worker import run_prefork
 
 
 class StandaloneApplication(BaseApplication):
@@ -28,6 +37,130 @@ class StandaloneApplication(BaseApplication):
         return self.application
 
 
+def checkpoint_key(account_id: str) -> str:
+    return f"user:{account_id}, run_once_transfers"
+
+
+def dump_transfer(transfer: Transfer) -> str:
+    copy_to = None if transfer.copy_to is None else transfer.copy_to.as_posix()
+    return json.dumps(
+        {
+            "move_to": transfer.move_to.as_posix(),
+            "copy_to": copy_to,
+            "error_path": transfer.error_path.as_posix(),
+        }
+    )
+
+
+def load_transfer(from_path: Path, value: bytes) -> Transfer:
+    data = json.loads(value.decode())
+    return Transfer(
+        from_path=from_path,
+        move_to=Path(data["move_to"]),
+        copy_to=None if data["copy_to"] is None else Path(data["copy_to"]),
+        error_path=Path(data["error_path"]),
+    )
+
+
+def run_once(account_id: str, jobs: int = 1) -> None:
+    """Process all entries in the account's uploads folder, jobs at a time.
+    Entries stay in the uploads folder until their transfers are flushed, every
+    checkpoint_interval entries. Until then, the transfers of processed entries
+    are kept in Redis, so a restart after an interruption only finishes those
+    transfers instead of processing the entries again. Entries that were moved
+    are no longer listed, so they need no record"""
+    redis_client = server.redis_client
+    dbx = RetryingDropbox(
+        config.get_dbx_token(redis_client, account_id),
+        account_id=account_id,
+        redis_client=redis_client,
+    )
+    settings = config.Settings(dbx)
+    transfers = TransferBatcher(dbx)
+    known_folders = Task.load_folders_from_cache(account_id, dbx)
+    key = checkpoint_key(account_id)
+    interrupted = redis_client.hgetall(key)
+    entry_ids: t.Dict[Path, str] = {}
+    unflushed: t.Dict[Path, str] = {}
+    n_results = 0
+
+    def resume(entry: dropbox.files.FileMetadata, entry_id: str) -> None:
+        value = interrupted[entry_id.encode()]
+        transfer = load_transfer(Path(entry.path_display), value)
+        if transfer.copy_to is not None:
+            # the run may have stopped between copying and moving
+            try:
+                dbx.files_get_metadata(transfer.copy_to.as_posix())
+            except dropbox.exceptions.ApiError:
+                pass
+            else:
+                transfer.copy_to = None
+        transfers.add(
+            transfer.from_path, transfer.move_to, transfer.copy_to, transfer.error_path
+        )
+        unflushed[transfer.from_path] = entry_id
+
+    def tasks() -> t.Iterator[Task]:
+        n_resumed = 0
+        for entry in server.dbx_list_entries(dbx, config.uploads_path):
+            entry_id = f"{entry.path_lower}:{entry.content_hash}"
+            if entry_id.encode() in interrupted:
+                resume(entry, entry_id)
+                n_resumed += 1
+                continue
+            task = Task(
+                account_id,
+                entry,
+                config.review_path,
+                config.backup_path,
+                config.errors_path,
+            )
+            entry_ids[task.path] = entry_id
+            yield task
+        log.info(f"Resumed transfers from previous runs: {n_resumed}")
+
+    def checkpoint() -> None:
+        nonlocal n_results
+        transfers.flush()
+        # including transfers flushed by the batcher itself, once it was full
+        flushed = [
+            unflushed.pop(result.from_path)
+            for result in transfers.results[n_results:]
+            if result.from_path in unflushed
+        ]
+        n_results = len(transfers.results)
+        if flushed:
+            redis_client.hdel(key, *flushed)
+
+    def on_result(task: Task, result: str) -> None:
+        entry_id = entry_ids.pop(task.path)
+        transfer = transfers.pending_transfer(task.path)
+        if result == "failed" or transfer is None:
+            return
+        redis_client.hset(key, entry_id, dump_transfer(transfer))
+        redis_client.expire(key, seconds_in_fortnight)
+        unflushed[task.path] = entry_id
+        if len(unflushed) >= config.checkpoint_interval:
+            checkpoint()
+
+    stats = run_pipeline(
+        tasks(),
+        redis_client,
+        dbx,
+        settings,
+        known_folders,
+        on_result=on_result,
+        transfers=transfers,
+        io_workers=jobs,
+        cpu_workers=jobs,
+        window=2 * jobs,
+    )
+    checkpoint()
+    # transfers of entries that have since left the uploads folder otherwise
+    redis_client.delete(key)
+    log.info(stats.summary())
+
+
 def main() -> None:
     try:
         log.info("Starting kamera")
@@ -37,6 +170,11 @@ def main() -> None:
         parser.add_argument("--bind", "-b", default="0.0.0.0")
         parser.add_argument("--workers", "-w", default=3)
         parser.add_argument("--port", "-p")
+        parser.add_argument("--concurrency", "-c", type=int, default=1)
+        parser.add_argument("--max-jobs", type=int)
+        parser.add_argument("--max-memory", type=int, help="MB per worker process")
+        parser.add_argument("--jobs", "-j", type=int, default=1)
+        parser.add_argument("--account", "-a", help="account ID, for run_once")
         args = parser.parse_args()
 
         if args.mode == "server":
@@ -49,23 +187,22 @@ def main() -> None:
                 gunicorn_app.run()
             elif args.debug is True:
                 server.app.run()
+        elif args.mode == "worker" and args.concurrency > 1:
+            run_prefork(
+                [server.queue], args.concurrency, args.max_jobs, args.max_memory
+            )
         elif args.mode == "worker":
             with rq.Connection(server.redis_client):
                 worker = rq.SimpleWorker(queues=[server.queue])
                 worker.work()
+        elif args.mode == "sync_worker":
+            with rq.Connection(server.redis_client):
+                worker = rq.SimpleWorker(queues=[server.sync_queue])
+                worker.work()
         elif args.mode == "run_once":
-            account_id = sys.argv[2]
-            dbx = dropbox.Dropbox(config.get_dbx_token(server.redis_client, account_id))
-            settings = config.Settings(dbx)
-            for entry in server.dbx_list_entries(dbx, config.uploads_path):
-                task = Task(
-                    account_id,
-                    entry,
-                    config.review_path,
-                    config.backup_path,
-                    config.errors_path,
-                )
-                task.process_entry(server.redis_client, dbx, settings)
+            if args.account is None:
+                parser.error("--account is required with --mode run_once")
+            run_once(args.account, args.jobs)
     except Exception:
         log.exception("Exception in main loop")
         raise
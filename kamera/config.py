@@ -1,10 +1,14 @@
 #! /usr/bin/env python3
 # coding: utf-8
 import json
+import logging
 import os
+import time
 import typing as t
 from collections import defaultdict
-from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
 from io import BytesIO
 from pathlib import Path
 
@@ -14,8 +18,9 @@ import numpy as np
 import yaml
 from dotenv import load_dotenv
 from dropbox import Dropbox
+from dropbox.files import FileMetadata
 from redis import Redis
-from requests import Response
+from scipy.spatial import cKDTree
 
 env_path = Path(".") / ".env"
 load_dotenv(dotenv_path=env_path)
@@ -38,6 +43,41 @@ review_path = dbx_path / "Review"
 backup_path = dbx_path / "Backup"
 errors_path = dbx_path / "Error"
 config_path = dbx_path / "config"
+gallery_file = config_path / "gallery.npz"
+
+hash_algorithm = os.environ.get("hash_algorithm", "whash")
+duplicate_hash_distance = int(os.environ.get("duplicate_hash_distance", 4))
+
+sync_pending_ttl = int(os.environ.get("sync_pending_ttl", 600))
+full_listing_interval = int(os.environ.get("full_listing_interval", 3600))
+batch_target_jobs = int(os.environ.get("batch_target_jobs", 8))
+batch_max_size = int(os.environ.get("batch_max_size", 50))
+entry_timeout = int(os.environ.get("entry_timeout", 180))  # seconds per batch entry
+pipeline_io_workers = int(os.environ.get("pipeline_io_workers", 4))
+pipeline_cpu_workers = int(os.environ.get("pipeline_cpu_workers", os.cpu_count() or 1))
+pipeline_window = int(os.environ.get("pipeline_window", 8))
+checkpoint_interval = int(os.environ.get("checkpoint_interval", 100))
+
+folder_cache_ttl = int(os.environ.get("folder_cache_ttl", 3600))
+
+settings_ttl = int(os.environ.get("settings_ttl", 60))
+settings_cache_size = int(os.environ.get("settings_cache_size", 100))
+recognition_download_workers = int(os.environ.get("recognition_download_workers", 8))
+recognition_encode_workers = int(
+    os.environ.get("recognition_encode_workers", os.cpu_count() or 1)
+)
+
+dbx_max_attempts = int(os.environ.get("dbx_max_attempts", 5))
+dbx_backoff_base = float(os.environ.get("dbx_backoff_base", 0.5))
+dbx_backoff_max = float(os.environ.get("dbx_backoff_max", 60))
+dbx_rate_limit = float(os.environ.get("dbx_rate_limit", 10))
+dbx_burst_limit = int(os.environ.get("dbx_burst_limit", 20))
+dbx_pool_size = int(os.environ.get("dbx_pool_size", 16))
+dbx_connect_timeout = float(os.environ.get("dbx_connect_timeout", 10))
+dbx_read_timeout = float(os.environ.get("dbx_read_timeout", 100))
+
+timezone_precision = int(os.environ.get("timezone_precision", 3))
+timezone_cache_size = int(os.environ.get("timezone_cache_size", 4096))
 
 rq_dashboard_username = os.environ["rq_dashboard_username"]
 rq_dashboard_password = os.environ["rq_dashboard_password"]
@@ -48,12 +88,46 @@ media_extensions = tuple(image_extensions | video_extensions)
 
 
 # type alias
-facial_encoding = t.Sequence[np.float64]  # actually np.ndarray
+facial_encoding = np.ndarray
 
 
 class Settings:
+    """Account settings, loaded from the files under config_path. Files are
+    listed with their content hashes, so refresh can reload only those that
+    changed since they were loaded."""
+
     def __init__(self, dbx: Dropbox) -> None:
-        settings_data = _load_settings(dbx)
+        self.content_hashes: t.Dict[str, t.Optional[str]] = {}
+        self.encoding_sources: t.Dict[str, t.Tuple[str, t.Optional[str]]] = {}
+        self.encodings: t.Dict[str, t.Tuple[str, facial_encoding]] = {}
+        self.refresh(dbx)
+
+    def refresh(self, dbx: Dropbox) -> bool:
+        """Reload changed config files. Returns whether anything was reloaded"""
+        files = _list_config_files(dbx)
+        # written by _set_people, and not a change in itself
+        gallery = files.pop(gallery_file.as_posix().lower(), None)
+        content_hashes = {path: entry.content_hash for path, entry in files.items()}
+        differences = set(content_hashes.items()) ^ set(self.content_hashes.items())
+        changed = {path for path, _ in differences}
+        loaded = bool(self.content_hashes)
+        self.checked_at = time.monotonic()
+        if loaded and not changed:
+            return False
+
+        settings_file = (config_path / "settings.yaml").as_posix().lower()
+        if not loaded or settings_file in changed:
+            self._set_settings(_load_settings(dbx))
+        places_file = (config_path / "places.yaml").as_posix().lower()
+        if not loaded or places_file in changed:
+            self._set_locations(dbx)
+        people_path = (config_path / "people").as_posix().lower()
+        if not loaded or any(path.startswith(people_path + "/") for path in changed):
+            self._set_people(dbx, files, people_path, gallery)
+        self.content_hashes = content_hashes
+        return True
+
+    def _set_settings(self, settings_data: dict) -> None:
         self.default_tz: str = settings_data["default_tz"]
         self.recognition_tolerance: float = settings_data["recognition_tolerance"]
 
@@ -75,21 +149,122 @@ class Settings:
                 11: "11",
                 12: "12",
             }
+        self.face_detection = FaceDetection(**settings_data.get("face_detection", {}))
+
         self.tag_swaps: t.Dict[str, str]
         try:
             self.tag_swaps = settings_data.pop("tag_swaps")
         except KeyError:
             self.tag_swaps = {}
 
+    def _set_locations(self, dbx: Dropbox) -> None:
         self.locations: t.List[Area]
         try:
             location_data = _load_location_data(dbx)
             self.locations = location_data
         except dropbox.exceptions.ApiError:
             self.locations = []
-        recognition_data = _load_recognition_data(dbx)
-
+        self.location_index = PlaceIndex(self.locations)
+
+    def _set_people(
+        self,
+        dbx: Dropbox,
+        files: t.Dict[str, FileMetadata],
+        people_path: str,
+        gallery: t.Optional[FileMetadata],
+    ) -> None:
+        if not self.encoding_sources and gallery is not None:
+            _, response = dbx.files_download(gallery.path_display)
+            for path, (content_hash, name, encoding) in _read_gallery(
+                response.raw.data, people_path
+            ).items():
+                key, _ = os.path.splitext(path)
+                self.encoding_sources[key] = (path, content_hash)
+                if encoding is not None:
+                    self.encodings[key] = (name, encoding)
+
+        # Each encoding is loaded from its json file, or from the image if it
+        # hasn't been encoded yet
+        sources: t.Dict[str, FileMetadata] = {}
+        for path, entry in sorted(files.items()):
+            if not path.startswith(people_path + "/"):
+                continue
+            key, suffix = os.path.splitext(path)
+            if suffix == ".json" or (suffix in image_extensions and key not in sources):
+                sources[key] = entry
+
+        removed = set(self.encoding_sources) - set(sources)
+        for key in removed:
+            del self.encoding_sources[key]
+            self.encodings.pop(key, None)
+        to_load = {
+            key: entry
+            for key, entry in sources.items()
+            if self.encoding_sources.get(key) != (entry.path_lower, entry.content_hash)
+        }
+        load_files = [Path(entry.path_display) for entry in to_load.values()]
+        loaded_encodings = _load_encodings(dbx, load_files)
+        for (key, entry), file, encoding in zip(
+            to_load.items(), load_files, loaded_encodings
+        ):
+            self.encoding_sources[key] = (entry.path_lower, entry.content_hash)
+            if encoding is None:
+                self.encodings.pop(key, None)
+            else:
+                self.encodings[key] = (file.parents[0].name, encoding)
+
+        recognition_data: t.Dict[str, t.List[facial_encoding]] = defaultdict(list)
+        for key in sorted(self.encodings):
+            name, encoding = self.encodings[key]
+            recognition_data[name].append(encoding)
         self.recognition_data: t.Dict[str, t.List[facial_encoding]] = recognition_data
+        self.known_faces = KnownFaces(recognition_data)
+
+        if removed or to_load:
+            gallery_data = _write_gallery(
+                self.encoding_sources, self.encodings, people_path
+            )
+            # only saves loading next time, so settings are usable without it
+            try:
+                dbx.files_upload(
+                    f=gallery_data,
+                    path=gallery_file.as_posix(),
+                    mode=dropbox.files.WriteMode.overwrite,
+                )
+            except Exception:
+                # not kamera.logger, which would be set up before .env is loaded
+                logging.exception("Unable to save face gallery")
+
+
+class KnownFaces:
+    """All known encodings stacked into one contiguous float32 matrix, grouped by
+    person, so an image's faces can be matched with a single distance computation.
+
+    Attributes:
+        names: person names, sorted
+        encodings: matrix of encodings, one row per encoding
+        labels: index into names for each row of encodings
+        group_starts: index of first row of each person's encodings
+        squared_norms: squared norm of each row of encodings
+    """
+
+    def __init__(self, recognition_data: t.Dict[str, t.List[facial_encoding]]) -> None:
+        self.names: t.List[str] = sorted(
+            name for name, encodings in recognition_data.items() if encodings
+        )
+        counts = [len(recognition_data[name]) for name in self.names]
+        rows = [encoding for name in self.names for encoding in recognition_data[name]]
+        self.encodings: np.ndarray = np.ascontiguousarray(rows, dtype=np.float32)
+        if not rows:
+            self.encodings = self.encodings.reshape(0, 0)
+        self.labels: np.ndarray = np.repeat(np.arange(len(self.names)), counts)
+        self.group_starts: np.ndarray = np.cumsum([0] + counts)[:-1]
+        self.squared_norms: np.ndarray = np.einsum(
+            "ij,ij->i", self.encodings, self.encodings
+        )
+
+    def __len__(self) -> int:
+        return len(self.names)
 
 
 def _load_settings(dbx: Dropbox) -> dict:
@@ -99,6 +274,57 @@ def _load_settings(dbx: Dropbox) -> dict:
     return settings
 
 
+@dataclass(frozen=True)
+class FaceDetection:
+    """Face detection settings. Faces are located on a copy of the image scaled down
+    so its longest side is at most `size` pixels (None for full resolution), and
+    encoded at full resolution."""
+
+    size: t.Optional[int] = None
+    upsample: int = 1
+    num_jitters: int = 1
+    model: str = "hog"
+
+    def __post_init__(self) -> None:
+        if self.model not in ("hog", "cnn"):
+            raise ValueError(f"Unknown face detection model: {self.model}")
+
+
+# same mean earth radius as geopy's great_circle
+earth_radius_km = 6371.009
+
+Place = t.TypeVar("Place", "Spot", "Area")
+
+
+class PlaceIndex(t.Generic[Place]):
+    """Nearest-place lookup, using a k-d tree over points on the unit sphere.
+    Straight-line distance between points on the sphere grows with great-circle
+    distance, so the nearest point in the tree is also the nearest place."""
+
+    def __init__(self, places: t.Sequence[Place]) -> None:
+        self.places: t.List[Place] = list(places)
+        self.tree = (
+            cKDTree(_unit_vectors([(place.lat, place.lng) for place in self.places]))
+            if self.places
+            else None
+        )
+
+    def nearest(self, lat: float, lng: float) -> t.Tuple[float, t.Optional[Place]]:
+        """Return great-circle distance in km to the nearest place, and the place"""
+        if self.tree is None:
+            return float("inf"), None
+        chord, i = self.tree.query(_unit_vectors([(lat, lng)])[0])
+        distance = 2 * np.arcsin(min(chord / 2, 1.0)) * earth_radius_km
+        return distance, self.places[i]
+
+
+def _unit_vectors(coordinates: t.Sequence[t.Tuple[float, float]]) -> np.ndarray:
+    lat, lng = np.radians(np.asarray(coordinates, dtype=np.float64)).T
+    return np.column_stack(
+        (np.cos(lat) * np.cos(lng), np.cos(lat) * np.sin(lng), np.sin(lat))
+    )
+
+
 @dataclass(frozen=True)
 class Spot:
     name: str
@@ -112,6 +338,10 @@ class Area:
     lat: float
     lng: float
     spots: t.List[Spot]
+    spot_index: PlaceIndex[Spot] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        object.__setattr__(self, "spot_index", PlaceIndex(self.spots))
 
 
 def _load_location_data(dbx: Dropbox) -> t.List[Area]:
@@ -130,52 +360,112 @@ def _load_location_data(dbx: Dropbox) -> t.List[Area]:
     return areas
 
 
-def _load_recognition_data(dbx: Dropbox) -> t.Dict[str, t.List[facial_encoding]]:
-    recognition_path = config_path / "people"
-    result = dbx.files_list_folder(path=recognition_path.as_posix(), recursive=True)
-
-    people: t.Dict[str, t.List[facial_encoding]] = defaultdict(list)
+def _list_config_files(dbx: Dropbox) -> t.Dict[str, FileMetadata]:
+    """All files under config_path, by lower case path"""
+    result = dbx.files_list_folder(path=config_path.as_posix(), recursive=True)
+    files = {}
+    while True:
+        for entry in result.entries:
+            if isinstance(entry, FileMetadata):
+                files[entry.path_lower] = entry
+        if not result.has_more:
+            break
+        result = dbx.files_list_folder_continue(result.cursor)
+    return files
 
-    paths = {Path(entry.path_display) for entry in result.entries}
-    json_files = {path for path in paths if path.suffix == ".json"}
-    for file in json_files:
-        _load_encoding_json(file, dbx, people)
 
-    unencoded_imgs = {
-        path
-        for path in paths
-        if (
-            path.suffix.lower() in image_extensions
-            and path.with_suffix(".json") not in json_files
+def _download(dbx: Dropbox, file: Path) -> bytes:
+    _, response = dbx.files_download(file.as_posix())
+    return response.raw.data
+
+
+def _load_encodings(
+    dbx: Dropbox, files: t.List[Path]
+) -> t.List[t.Optional[facial_encoding]]:
+    """Load encodings from json files, or from reference images without one.
+    Files are downloaded in a thread pool, and images are encoded in a process
+    pool."""
+    with ThreadPoolExecutor(recognition_download_workers) as executor:
+        datas = list(executor.map(partial(_download, dbx), files))
+
+    encodings: t.List[t.Optional[facial_encoding]] = [None] * len(files)
+    imgs = []
+    for i, (file, data) in enumerate(zip(files, datas)):
+        if file.suffix.lower() == ".json":
+            encodings[i] = np.array(json.loads(data))
+        else:
+            imgs.append(i)
+    if not imgs:
+        return encodings
+
+    img_files = [files[i] for i in imgs]
+    img_datas = [datas[i] for i in imgs]
+    if len(imgs) == 1:
+        img_encodings = [_get_facial_encoding(img_datas[0], img_files[0])]
+    else:
+        with ProcessPoolExecutor(recognition_encode_workers) as executor:
+            img_encodings = list(
+                executor.map(_get_facial_encoding, img_datas, img_files)
+            )
+    for i, encoding in zip(imgs, img_encodings):
+        encodings[i] = encoding
+    return encodings
+
+
+def _write_gallery(
+    encoding_sources: t.Dict[str, t.Tuple[str, t.Optional[str]]],
+    encodings: t.Dict[str, t.Tuple[str, facial_encoding]],
+    people_path: str,
+) -> bytes:
+    """Serialize loaded encodings, with the path and content hash of the file each
+    was loaded from, into an uncompressed npz archive of plain arrays"""
+    keys = sorted(encoding_sources)
+    rows = [encodings.get(key) for key in keys]
+    encoding_matrix = np.zeros((len(keys), 128), dtype=np.float32)
+    for i, row in enumerate(rows):
+        if row is not None:
+            encoding_matrix[i] = row[1]
+    file = BytesIO()
+    np.savez(
+        file,
+        paths=np.array(
+            [encoding_sources[key][0][len(people_path) + 1 :] for key in keys],
+            dtype=str,
+        ),
+        content_hashes=np.array(
+            [encoding_sources[key][1] or "" for key in keys], dtype=str
+        ),
+        names=np.array([row[0] if row else "" for row in rows], dtype=str),
+        found=np.array([row is not None for row in rows], dtype=bool),
+        encodings=encoding_matrix,
+    )
+    return file.getvalue()
+
+
+def _read_gallery(
+    data: bytes, people_path: str
+) -> t.Dict[str, t.Tuple[t.Optional[str], str, t.Optional[facial_encoding]]]:
+    """Read a gallery written by _write_gallery into a dict of
+    path: (content hash, name, encoding)"""
+    gallery = np.load(BytesIO(data), allow_pickle=False)
+    return {
+        f"{people_path}/{path}": (
+            content_hash or None,
+            name,
+            encoding if found else None,
+        )
+        for path, content_hash, name, found, encoding in zip(
+            gallery["paths"].tolist(),
+            gallery["content_hashes"].tolist(),
+            gallery["names"].tolist(),
+            gallery["found"].tolist(),
+            gallery["encodings"],
         )
     }
-    for file in unencoded_imgs:
-        _load_encoding_img(file, dbx, people)
-    return people
-
-
-def _load_encoding_json(file: Path, dbx: Dropbox, people: t.Dict[str, t.List]) -> None:
-    name = file.parents[0].name
-    _, response = dbx.files_download(file.as_posix())
-    encoding: facial_encoding = np.array(json.loads(response.raw.data))
-    people[name].append(encoding)
-
-
-def _load_encoding_img(img: Path, dbx: Dropbox, people: t.Dict[str, t.List]) -> None:
-    name = img.parents[0].name
-    _, response = dbx.files_download(img.as_posix())
-    encoding = _get_facial_encoding(response, img)
-    if encoding is None:
-        return
-    json_encoded = json.dumps(encoding.tolist())  # type: ignore
-    dbx.files_upload(f=json_encoded.encode(), path=img.with_suffix(".json").as_posix())
-    people[name].append(encoding)
 
 
-def _get_facial_encoding(
-    response: Response, img_path: Path
-) -> t.Optional[facial_encoding]:
-    loaded_img = face_recognition.load_image_file(BytesIO(response.raw.data))
+def _get_facial_encoding(data: bytes, img_path: Path) -> t.Optional[facial_encoding]:
+    loaded_img = face_recognition.load_image_file(BytesIO(data))
     encodings = face_recognition.face_encodings(loaded_img)
     if len(encodings) == 0:
         print(f"Warning: No encodings found: {img_path}")
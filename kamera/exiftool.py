@@ -0,0 +1,139 @@
+#! /usr/bin/env python3
+# coding: utf-8
+import atexit
+import os
+import subprocess
+import sys
+import tempfile
+import typing as t
+from pathlib import Path
+
+from kamera.logger import log
+
+
+class ExifToolError(Exception):
+    pass
+
+
+class ExifTool:
+    """Long-lived exiftool process, driven with -stay_open through an argfile on
+    stdin. Each command is terminated by -executeN, and exiftool answers with
+    {readyN} on stdout once the command is done."""
+
+    def __init__(self, executable: str = "exiftool") -> None:
+        self.executable = executable
+        self.process: t.Optional[subprocess.Popen] = None
+        self.n_commands = 0
+
+    def start(self) -> None:
+        args = [self.executable, "-stay_open", "True", "-@", "-"]
+        self.process = subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        log.debug(f"Started exiftool, pid: {self.process.pid}")
+
+    def _pipes(self) -> t.Tuple[t.IO[bytes], t.IO[bytes]]:
+        if (
+            self.process is None
+            or self.process.stdin is None
+            or self.process.stdout is None
+        ):
+            raise ExifToolError("exiftool is not running")
+        return self.process.stdin, self.process.stdout
+
+    def close(self) -> None:
+        if self.process is None:
+            return
+        try:
+            stdin, _ = self._pipes()
+            stdin.write(b"-stay_open\nFalse\n")
+            stdin.flush()
+            self.process.communicate(timeout=5)
+        except (OSError, ValueError, subprocess.TimeoutExpired, ExifToolError):
+            self.process.kill()
+        self.process = None
+
+    @property
+    def running(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def _read_until(self, marker: bytes) -> bytes:
+        output = b""
+        _, stdout = self._pipes()
+        fileno = stdout.fileno()
+        while not output.rstrip().endswith(marker):
+            chunk = os.read(fileno, 4096)
+            if not chunk:
+                raise ExifToolError("exiftool exited unexpectedly")
+            output += chunk
+        return output
+
+    def execute_batch(self, commands: t.List[t.List[str]]) -> bytes:
+        """Send all commands in one write and wait for the last one to finish"""
+        if not self.running:
+            self.start()
+        argfile = []
+        for command in commands:
+            self.n_commands += 1
+            argfile.extend(command)
+            argfile.append(f"-execute{self.n_commands}")
+        marker = f"{{ready{self.n_commands}}}".encode()
+        try:
+            stdin, _ = self._pipes()
+            stdin.write(("\n".join(argfile) + "\n").encode())
+            stdin.flush()
+            return self._read_until(marker)
+        except (OSError, ExifToolError):
+            self.close()
+            raise ExifToolError("exiftool crashed")
+
+    def tag_batch(self, items: t.List[t.Tuple[bytes, t.List[str]]]) -> t.List[bytes]:
+        """Add xmp:Subject tags to several images in a single round trip"""
+        with tempfile.TemporaryDirectory(prefix="kamera") as tmpdir:
+            commands = []
+            out_files = []
+            for i, (data, tags) in enumerate(items):
+                in_file = Path(tmpdir, f"in_{i}.jpg")
+                out_file = Path(tmpdir, f"out_{i}.jpg")
+                in_file.write_bytes(data)
+                command = []
+                if sys.platform == "win32":
+                    command.append("-L")
+                for tag in tags:
+                    # remove then add, to merge with existing subjects
+                    command.extend([f"-xmp:Subject-={tag}", f"-xmp:Subject+={tag}"])
+                command.extend(["-o", out_file.as_posix(), in_file.as_posix()])
+                commands.append(command)
+                out_files.append(out_file)
+            try:
+                self.execute_batch(commands)
+            except ExifToolError:
+                log.info("exiftool crashed, restarting")
+                for out_file in out_files:
+                    if out_file.exists():
+                        out_file.unlink()
+                self.execute_batch(commands)
+            try:
+                return [out_file.read_bytes() for out_file in out_files]
+            except FileNotFoundError:
+                raise ExifToolError("exiftool did not write tagged image")
+
+    def tag(self, data: bytes, tags: t.List[str]) -> bytes:
+        return self.tag_batch([(data, tags)])[0]
+
+
+_exiftool: t.Optional[ExifTool] = None
+_exiftool_pid: t.Optional[int] = None
+
+
+def get_exiftool() -> ExifTool:
+    """Return the exiftool process owned by the current worker process"""
+    global _exiftool, _exiftool_pid
+    if _exiftool is None or _exiftool_pid != os.getpid():
+        _exiftool = ExifTool()
+        _exiftool_pid = os.getpid()
+        atexit.register(_exiftool.close)
+    return _exiftool
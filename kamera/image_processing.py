@@ -2,30 +2,26 @@
 # coding: utf-8
 import copy
 import datetime as dt
-import subprocess
-import sys
 import typing as t
+from dataclasses import dataclass
 from io import BytesIO
 from pathlib import Path
 
 import dropbox
+import imagehash
 import piexif
-from geopy.distance import great_circle
 from PIL import Image
 from resizeimage import resizeimage
 
-from kamera import config, recognition
+from kamera import config, exiftool, recognition, xmp
 from kamera.logger import log
 
 
 def get_closest_area(
-    lat: float, lng: float, locations: t.List[config.Area]
+    lat: float, lng: float, location_index: config.PlaceIndex[config.Area]
 ) -> t.Optional[config.Area]:
     """Return area if image taken within 50 km from center of area"""
-    distances = [
-        (great_circle((area.lat, area.lng), (lat, lng)).km, area) for area in locations
-    ]
-    distance, closest_area = min(distances)
+    distance, closest_area = location_index.nearest(lat, lng)
     return closest_area if distance < 50 else None
 
 
@@ -36,20 +32,16 @@ def get_closest_spot(
     if not area.spots:
         return None
 
-    distances = [
-        (great_circle((spot.lat, spot.lng), (lat, lng)).meters, spot)
-        for spot in area.spots
-    ]
-    distance, closest_spot = min(distances)
-    return closest_spot if distance < 100 else None
+    distance, closest_spot = area.spot_index.nearest(lat, lng)
+    return closest_spot if distance * 1000 < 100 else None
 
 
 def get_geo_tag(
-    lat: float, lng: float, locations: t.List[config.Area]
+    lat: float, lng: float, location_index: config.PlaceIndex[config.Area]
 ) -> t.Optional[str]:
     tagstring = None
     if lat and lng:
-        area = get_closest_area(lat, lng, locations)
+        area = get_closest_area(lat, lng, location_index)
         if area:
             spot = get_closest_spot(lat, lng, area)
             if spot:
@@ -59,35 +51,26 @@ def get_geo_tag(
     return tagstring
 
 
-def convert_png_to_jpg(data: bytes) -> bytes:
-    old_data = BytesIO(data)
-    new_data = BytesIO()
-    Image.open(old_data).save(new_data, "JPEG")
-    data = new_data.getvalue()
-    return data
+def convert_png_to_jpg(img: Image.Image) -> Image.Image:
+    return img.convert("RGB")
 
 
-def resize(data: bytes, exif: dict) -> t.Tuple[bytes, dict]:
-    img = Image.open(BytesIO(data))
+def resize(img: Image.Image, exif: dict) -> t.Tuple[Image.Image, dict]:
     landscape = True if img.width > img.height else False
     if landscape:
         img = resizeimage.resize_height(img, size=1440)
     else:
         img = resizeimage.resize_width(img, size=1440)
-    bytes_io = BytesIO()
-    img.save(bytes_io, "JPEG")
-    new_data = bytes_io.getvalue()
     new_exif = copy.deepcopy(exif)
     width, height = img.size
     new_exif["0th"][piexif.ImageIFD.ImageWidth] = width
     new_exif["0th"][piexif.ImageIFD.ImageLength] = height
-    return new_data, new_exif
+    return img, new_exif
 
 
-def rotate(data: bytes, exif: dict) -> t.Tuple[bytes, dict]:
+def rotate(img: Image.Image, exif: dict) -> t.Tuple[Image.Image, dict]:
     """Based on
     piexif.readthedocs.io/en/latest/sample.html#rotate-image-by-exif-orientation"""
-    img = Image.open(BytesIO(data))
     orientation = exif["0th"][piexif.ImageIFD.Orientation]
     if orientation == 2:
         img = img.transpose(Image.FLIP_LEFT_RIGHT)
@@ -103,15 +86,38 @@ def rotate(data: bytes, exif: dict) -> t.Tuple[bytes, dict]:
         img = img.rotate(90, expand=True).transpose(Image.FLIP_LEFT_RIGHT)
     elif orientation == 8:
         img = img.rotate(90, expand=True)
-    bytes_io = BytesIO()
-    img.save(bytes_io, "JPEG")
-    new_data = bytes_io.getvalue()
     new_exif = copy.deepcopy(exif)
     width, height = img.size
     new_exif["0th"][piexif.ImageIFD.ImageWidth] = width
     new_exif["0th"][piexif.ImageIFD.ImageLength] = height
     new_exif["0th"][piexif.ImageIFD.Orientation] = 1
-    return new_data, new_exif
+    return img, new_exif
+
+
+def encode_jpg(img: Image.Image) -> bytes:
+    bytes_io = BytesIO()
+    img.save(bytes_io, "JPEG")
+    data = bytes_io.getvalue()
+    return data
+
+
+hash_functions: t.Dict[str, t.Callable[[Image.Image], imagehash.ImageHash]] = {
+    "whash": imagehash.whash,
+    "phash": imagehash.phash,
+    "dhash": imagehash.dhash,
+    "average_hash": imagehash.average_hash,
+}
+hash_height = 500
+
+
+def get_hash(img: Image.Image, algorithm: str = config.hash_algorithm) -> str:
+    hash_function = hash_functions[algorithm]
+    # All hash algorithms work on grayscale
+    small_img = img.convert("L")
+    if small_img.height > hash_height:
+        small_img = resizeimage.resize_height(small_img, size=hash_height)
+    img_hash = hash_function(small_img)
+    return str(img_hash)
 
 
 def add_date(date: dt.datetime, metadata: dict):
@@ -121,17 +127,26 @@ def add_date(date: dt.datetime, metadata: dict):
 
 def add_tag(data: bytes, tags: t.List[str]) -> bytes:
     # metadata["0th"][piexif.ImageIFD.XPKeywords] = tagstring.encode("utf-16")
-    args = ["exiftool"]
-    if sys.platform == "win32":
-        args.append("-L")
-    args.extend([f"-xmp:Subject={tag}" for tag in tags])
-    args.append("-")
-    proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    stdout, stderr = proc.communicate(data)
-    new_data = stdout
+    try:
+        new_data = xmp.add_subjects(data, tags)
+    except xmp.XMPError as exc:
+        log.info(f"Unable to write XMP in-process ({exc}), using exiftool")
+        new_data = exiftool.get_exiftool().tag(data, tags)
     return new_data
 
 
+@dataclass(frozen=True)
+class ProcessedImage:
+    data: t.Optional[bytes]
+    img_hash: str
+
+
+def _load_exif(data: bytes, png: bool) -> dict:
+    if png:
+        return {"0th": {}, "Exif": {}, "GPS": {}, "Interop": {}, "1st": {}}
+    return piexif.load(data)
+
+
 def main(
     data: bytes,
     filepath: Path,
@@ -139,25 +154,34 @@ def main(
     settings: config.Settings,
     coordinates: t.Optional[dropbox.files.GpsCoordinates],
     dimensions: t.Optional[dropbox.files.Dimensions],
-) -> t.Optional[bytes]:
+) -> ProcessedImage:
+    """Decode image data once, apply all processing steps to the in-memory image,
+    and encode to JPEG at most once at the end.
+
+    Returns:
+        ProcessedImage with new image data (None if unchanged) and image hash
+    """
     data_changed = False
+    pixels_changed = False
     name = filepath.stem
-    # Convert image from PNG to JPG, put data into BytesIO obj
-    if filepath.suffix.lower() == ".png":
-        log.info(f"{name}: Converting to JPG")
-        data = convert_png_to_jpg(data)
-        data_changed = True
+    png = filepath.suffix.lower() == ".png"
+    img = Image.open(BytesIO(data))
     # Make metadata object from image data
-    exif_metadata = piexif.load(data)
+    exif_metadata = _load_exif(data, png)
+    # Convert image from PNG to JPG
+    if png:
+        log.info(f"{name}: Converting to JPG")
+        img = convert_png_to_jpg(img)
+        pixels_changed = True
     # Convert image to smaller resolution if needed
     if dimensions and dimensions.width > 1440 and dimensions.height > 1440:
         log.info(f"{name}: Resizing")
-        data, exif_metadata = resize(data, exif=exif_metadata)
-        data_changed = True
+        img, exif_metadata = resize(img, exif=exif_metadata)
+        pixels_changed = True
     # Rotate according to orientation tag
     if exif_metadata["0th"].get(piexif.ImageIFD.Orientation, 1) != 1:
-        data, exif_metadata = rotate(data, exif=exif_metadata)
-        data_changed = True
+        img, exif_metadata = rotate(img, exif=exif_metadata)
+        pixels_changed = True
     # Add date to metadata object if missing
     try:
         exif_metadata["Exif"][piexif.ExifIFD.DateTimeOriginal].decode()
@@ -171,13 +195,18 @@ def main(
         geotag = get_geo_tag(
             lat=coordinates.latitude,
             lng=coordinates.longitude,
-            locations=settings.locations,
+            location_index=settings.location_index,
         )
         if geotag is not None:
             tags.append(geotag)
     # Check if any recognized faces
-    peopletags = recognition.recognize_face(data, settings)
+    peopletags = recognition.recognize_face(img, settings)
     tags.extend(peopletags)
+    img_hash = get_hash(img)
+    # Encode in-memory image, only if its pixels were modified
+    if pixels_changed:
+        data = encode_jpg(img)
+        data_changed = True
     # Add tags to image data if present
     if tags:
         tags = [settings.tag_swaps.get(tag, tag) for tag in tags]
@@ -186,7 +215,7 @@ def main(
         data_changed = True
     # If no convertion, resizing,date fixing, or tagging, return
     if not data_changed:
-        return None
+        return ProcessedImage(data=None, img_hash=img_hash)
 
     # Add metadata from metadata object to image data
     try:
@@ -199,4 +228,4 @@ def main(
     new_file = BytesIO()
     piexif.insert(metadata_bytes, data, new_file)
     new_data = new_file.getvalue()
-    return new_data
+    return ProcessedImage(data=new_data, img_hash=img_hash)
@@ -1,13 +1,13 @@
 #! /usr/bin/env python3
 # coding: utf-8
 import typing as t
-from copy import deepcopy
 from dataclasses import dataclass, field
-from io import BytesIO
 
 import face_recognition
+import numpy as np
+from PIL import Image
 
-from kamera.config import Settings, facial_encoding
+from kamera.config import FaceDetection, KnownFaces, Settings, facial_encoding
 
 
 @dataclass(frozen=True, order=True)
@@ -16,55 +16,62 @@ class Match:
     name: str
 
 
-def _get_matches_for_encodings(
-    known_people: t.Dict[str, t.List[facial_encoding]],
-    unknown_encodings: t.List[facial_encoding],
-    tolerance: float,
-) -> t.List[t.List[Match]]:
+def _face_distances(
+    known_faces: KnownFaces, unknown_encodings: t.List[facial_encoding]
+) -> np.ndarray:
     """
-    Return possible matches for all encodings in image
+    Return euclidean distances from each unknown encoding to each known person's
+    closest encoding
 
     Args:
-        known_people: dictionary mapping names to lists of encodings
+        known_faces: all known encodings, grouped by person
         unknown_encodings: list of encodings from an image
 
     Returns:
-        matches: list of lists of matches, one list for each unknown_encoding
+        distances: matrix with one row per unknown encoding, one column per person
     """
-    match_lists = []
-    for unknown_encoding in unknown_encodings:
-        match_list = _match_face_with_known_people(
-            known_people, unknown_encoding, tolerance
-        )
-        if match_list:
-            match_lists.append(match_list)
-    return match_lists
+    unknown = np.asarray(unknown_encodings, dtype=np.float32)
+    # |a - b|^2 = |a|^2 + |b|^2 - 2ab, for all pairs at once
+    squared_distances = (
+        np.einsum("ij,ij->i", unknown, unknown)[:, np.newaxis]
+        + known_faces.squared_norms[np.newaxis, :]
+        - 2 * unknown @ known_faces.encodings.T
+    )
+    np.maximum(squared_distances, 0, out=squared_distances)
+    # Get most similar match for each person's encodings
+    closest = np.minimum.reduceat(squared_distances, known_faces.group_starts, axis=1)
+    return np.sqrt(closest)
 
 
-def _match_face_with_known_people(
-    known_people: t.Dict[str, t.List[facial_encoding]],
-    unknown_encoding: facial_encoding,
+def _get_matches_for_encodings(
+    known_faces: KnownFaces,
+    unknown_encodings: t.List[facial_encoding],
     tolerance: float,
-) -> t.List[Match]:
+) -> t.List[t.List[Match]]:
     """
-    Returns possible matches for a single unknown face encoding
+    Return possible matches for all encodings in image
 
     Args:
-        known_people: dictionary mapping names to lists of encodings
-        unknown_encoding: single encoding from an image
+        known_faces: all known encodings, grouped by person
+        unknown_encodings: list of encodings from an image
 
     Returns:
-        matches: list of matches, one match for each known person more
-        similar than tolerance
+        matches: list of lists of matches, one list for each unknown_encoding with
+        at least one known person more similar than tolerance
     """
-
-    match_list = []
-    for name, encodings in known_people.items():
-        # Get most similar match for each person's encodings
-        distance = min(face_recognition.face_distance(encodings, unknown_encoding))
-        if distance < tolerance:
-            match_list.append(Match(distance, name))
-    return match_list
+    if len(unknown_encodings) == 0 or len(known_faces) == 0:
+        return []
+    distances = _face_distances(known_faces, unknown_encodings)
+    match_lists = []
+    for face_distances in distances:
+        match_list = [
+            Match(float(distance), known_faces.names[i])
+            for i, distance in enumerate(face_distances)
+            if distance < tolerance
+        ]
+        if match_list:
+            match_lists.append(match_list)
+    return match_lists
 
 
 def _get_best_match_for_each_face(
@@ -97,14 +104,53 @@ def _get_best_match_for_each_face(
     return best_matches
 
 
-def recognize_face(img_data: bytes, settings: Settings) -> t.List[str]:
-    loaded_img = face_recognition.load_image_file(BytesIO(img_data))
-    unknown_encodings = face_recognition.face_encodings(loaded_img)
+def _detect_faces(
+    img: Image.Image, detection: FaceDetection
+) -> t.List[t.Tuple[int, int, int, int]]:
+    """
+    Return face locations in img, detected on a downscaled copy if configured
 
-    known_people = deepcopy(settings.recognition_data)
+    Returns:
+        face_locations: list of (top, right, bottom, left) in img coordinates
+    """
+    longest_side = max(img.size)
+    if detection.size is None or longest_side <= detection.size:
+        scale = 1.0
+        small_img = img
+    else:
+        scale = detection.size / longest_side
+        small_size = (round(img.width * scale), round(img.height * scale))
+        small_img = img.resize(small_size, Image.BILINEAR)
+    small_locations = face_recognition.face_locations(
+        np.array(small_img),
+        number_of_times_to_upsample=detection.upsample,
+        model=detection.model,
+    )
+    face_locations = [
+        (
+            max(round(top / scale), 0),
+            min(round(right / scale), img.width),
+            min(round(bottom / scale), img.height),
+            max(round(left / scale), 0),
+        )
+        for top, right, bottom, left in small_locations
+    ]
+    return face_locations
+
+
+def recognize_face(img: Image.Image, settings: Settings) -> t.List[str]:
+    img = img.convert("RGB")
+    face_locations = _detect_faces(img, settings.face_detection)
+    if not face_locations:
+        return []
+    unknown_encodings = face_recognition.face_encodings(
+        np.array(img),
+        known_face_locations=face_locations,
+        num_jitters=settings.face_detection.num_jitters,
+    )
 
     match_lists = _get_matches_for_encodings(
-        known_people=known_people,
+        known_faces=settings.known_faces,
         unknown_encodings=unknown_encodings,
         tolerance=settings.recognition_tolerance,
     )
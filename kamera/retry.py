@@ -0,0 +1,199 @@
+#! /usr/bin/env python3
+# coding: utf-8
+import os
+import random
+import re
+import time
+import typing as t
+from dataclasses import dataclass
+
+import dropbox
+import requests
+from redis import Redis
+
+from kamera import config
+from kamera.logger import log
+
+retryable_errors = (
+    dropbox.exceptions.RateLimitError,
+    dropbox.exceptions.InternalServerError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+)
+
+# Errors after which a request may have reached Dropbox, and been carried out
+unsent_errors = (requests.exceptions.ConnectTimeout,)
+maybe_sent_errors = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+# Routes that can't safely be sent twice: a repeated upload or relocation with
+# autorename makes a second copy, a repeated move or delete fails on the source
+non_idempotent_routes = {"upload", "move", "copy", "move_batch", "copy_batch", "delete"}
+
+
+def maybe_carried_out(exc: Exception) -> bool:
+    """Whether the request that failed with exc may have changed anything"""
+    if isinstance(exc, dropbox.exceptions.InternalServerError):
+        # 503: the request wasn't handled. Other 5xx can come after it was
+        return exc.status_code != 503
+    return isinstance(exc, maybe_sent_errors) and not isinstance(exc, unsent_errors)
+
+
+token_bucket_script = """
+local key = KEYS[1]
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+
+local state = redis.call("HMGET", key, "tokens", "updated", "blocked_until")
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+local blocked_until = tonumber(state[3]) or 0
+if blocked_until > now then
+    return tostring(blocked_until - now)
+end
+
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call("HMSET", key, "tokens", tostring(tokens), "updated", tostring(now))
+redis.call("EXPIRE", key, math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+
+
+class TokenBucket:
+    """Per-account request budget in Redis, shared by all workers, so that they
+    slow down together when the account is close to its rate limit"""
+
+    def __init__(
+        self,
+        redis_client: Redis,
+        account_id: str,
+        rate: float = config.dbx_rate_limit,
+        capacity: int = config.dbx_burst_limit,
+    ) -> None:
+        self.redis_client = redis_client
+        self.key = f"user:{account_id}, rate_limit"
+        self.rate = rate
+        self.capacity = capacity
+        self.script = redis_client.register_script(token_bucket_script)
+
+    def try_acquire(self) -> float:
+        """Take a token if one is available. Returns seconds to wait otherwise"""
+        wait = self.script(
+            keys=[self.key], args=[self.rate, self.capacity, time.time()]
+        )
+        return float(wait)
+
+    def acquire(self) -> None:
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def block(self, seconds: float) -> None:
+        """Hold back all workers of the account, e.g. for a Retry-After period"""
+        self.redis_client.hset(self.key, "blocked_until", time.time() + seconds)
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    max_attempts: int = config.dbx_max_attempts
+    base_delay: float = config.dbx_backoff_base
+    max_delay: float = config.dbx_backoff_max
+
+    def delay(self, attempt: int, retry_after: t.Optional[float] = None) -> float:
+        """Retry-After if given, otherwise exponential backoff with full jitter"""
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def call(
+        self,
+        bucket: t.Optional[TokenBucket],
+        func: t.Callable,
+        *args,
+        idempotent: bool = True,
+        **kwargs,
+    ) -> t.Any:
+        """Call func, retrying on retryable_errors. Unless idempotent, errors are
+        retried only if the request can't have been carried out"""
+        attempt = 0
+        while True:
+            if bucket is not None:
+                bucket.acquire()
+            try:
+                return func(*args, **kwargs)
+            except retryable_errors as exc:
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    raise
+                if not idempotent and maybe_carried_out(exc):
+                    raise
+                retry_after = getattr(exc, "backoff", None)
+                if retry_after is not None and bucket is not None:
+                    bucket.block(retry_after)
+                delay = self.delay(attempt - 1, retry_after)
+                log.info(f"{exc!r}: retrying in {delay:.1f}s (attempt {attempt})")
+                time.sleep(delay)
+
+
+_session: t.Optional[requests.Session] = None
+_session_pid: t.Optional[int] = None
+
+
+def get_session() -> requests.Session:
+    """Return the pooled HTTP session shared by all Dropbox clients of the current
+    process. Connections are kept alive between calls and clients, so each
+    account doesn't pay for new TLS handshakes"""
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        _session = dropbox.create_session(max_connections=config.dbx_pool_size)
+        _session_pid = os.getpid()
+    return _session
+
+
+class RetryingDropbox(dropbox.Dropbox):
+    """Dropbox client that runs every API call through a RetryPolicy, and a
+    TokenBucket when given a Redis client. The SDK's own retries are disabled so
+    that rate limits are handled in one place. Uses the process' shared HTTP
+    session unless given one."""
+
+    def __init__(
+        self,
+        oauth2_access_token: str,
+        account_id: t.Optional[str] = None,
+        redis_client: t.Optional[Redis] = None,
+        policy: RetryPolicy = RetryPolicy(),
+        **kwargs,
+    ) -> None:
+        kwargs.setdefault("max_retries_on_error", 0)
+        kwargs.setdefault("max_retries_on_rate_limit", 0)
+        kwargs.setdefault("session", get_session())
+        kwargs.setdefault(
+            "timeout", (config.dbx_connect_timeout, config.dbx_read_timeout)
+        )
+        super().__init__(oauth2_access_token, **kwargs)
+        self.policy = policy
+        self.bucket = (
+            TokenBucket(redis_client, account_id)
+            if redis_client is not None and account_id is not None
+            else None
+        )
+
+    def request(self, route, *args, **kwargs):
+        # route names have a version suffix in older SDK versions
+        name = re.sub(r"_v\d+$", "", route.name)
+        return self.policy.call(
+            self.bucket,
+            super().request,
+            route,
+            *args,
+            idempotent=name not in non_idempotent_routes,
+            **kwargs,
+        )
@@ -3,6 +3,7 @@
 import datetime as dt
 import hmac
 import json
+import time
 import typing as t
 from hashlib import sha256
 from pathlib import Path
@@ -17,7 +18,8 @@ from rq_dashboard.cli import add_basic_auth
 
 from kamera import config
 from kamera.logger import log
-from kamera.task import Task
+from kamera.retry import RetryingDropbox
+from kamera.task import Task, TaskBatch, add_jobs, batch_size, get_jobs
 
 app = Flask(__name__)
 
@@ -26,7 +28,8 @@ redis_client = redis.Redis(
     host=config.redis_host, port=config.redis_port, password=config.redis_password
 )
 queue = rq.Queue(connection=redis_client)
-running_jobs_registry = rq.registry.StartedJobRegistry(connection=redis_client)
+sync_queue = rq.Queue("sync", connection=redis_client)
+dbx_cache: t.Dict[t.Tuple[str, str], RetryingDropbox] = {}
 
 app.config.from_object(rq_dashboard.default_settings)  # type: ignore
 app.config["REDIS_HOST"] = config.redis_host
@@ -78,23 +81,31 @@ def get_n_queued(account_id: str) -> str:
     return str(n_jobs)
 
 
+def load_dbx_from_cache(account_id: str) -> RetryingDropbox:
+    token = config.get_dbx_token(redis_client, account_id)
+    try:
+        dbx = dbx_cache[(account_id, token)]
+    except KeyError:
+        dbx = RetryingDropbox(token, account_id=account_id, redis_client=redis_client)
+        dbx_cache[(account_id, token)] = dbx
+    return dbx
+
+
 def get_queued_and_running_jobs(account_id: str) -> t.Set[str]:
-    queued_and_running_jobs = set(
-        job_id
-        for job_id in (queue.job_ids + running_jobs_registry.get_job_ids())
-        if job_id.startswith(account_id)
-    )
-    return queued_and_running_jobs
+    return get_jobs(account_id, redis_client)
 
 
 def enqueue_new_entries(account_id: str):
     queued_and_running_jobs = get_queued_and_running_jobs(account_id)
     log.debug(str(queued_and_running_jobs))
-    token = config.get_dbx_token(redis_client, account_id)
-    dbx = dropbox.Dropbox(token)
-    for entry in dbx_list_entries(dbx, config.uploads_path):
+    dbx = load_dbx_from_cache(account_id)
+    entries, cursor = dbx_list_new_entries(dbx, account_id, config.uploads_path)
+    tasks = []
+    skipped = False
+    for entry in entries:
         job_id = f"{account_id}:{entry.name}"
         if job_id in queued_and_running_jobs:
+            skipped = True
             continue
         log.info(f"enqueing entry: {entry}")
         task = Task(
@@ -104,7 +115,22 @@ def enqueue_new_entries(account_id: str):
             config.backup_path,
             config.errors_path,
         )
-        queue.enqueue(task.main, result_ttl=600, job_id=job_id)
+        tasks.append(task)
+    size = batch_size(len(tasks))
+    for i in range(0, len(tasks), size):
+        batch = TaskBatch(account_id, tasks[i : i + size])
+        add_jobs(account_id, [task.job_id for task in batch.tasks], redis_client)
+        queue.enqueue(
+            batch.main,
+            result_ttl=600,
+            job_id=batch.job_id,
+            job_timeout=config.entry_timeout * len(batch.tasks),
+        )
+    if skipped:
+        # a skipped entry may be a new upload with the name of one whose job
+        # hasn't finished. Keeping the previous cursor lists it again next time
+        return
+    redis_client.hset(f"user:{account_id}", "uploads_cursor", cursor)
 
 
 @app.route("/webhook", methods=["POST"])
@@ -120,21 +146,55 @@ def webhook() -> str:
         if not is_rate_limit_exceeded(account_id):
             log.info(f"rate limit exceeded: {account_id}")
             continue
-        lock = redis_lock.Lock(redis_client, name=account_id, expire=60)
-        if not lock.acquire(blocking=False):
-            log.info(f"User request already being processed: {account_id}")
-            continue
         try:
-            enqueue_new_entries(account_id)
+            enqueue_sync(account_id)
         except Exception:
             log.exception(f"Exception occured, when handling request: {account_id}")
         finally:
             set_time_of_request(account_id)
-            lock.release()
-            log.info("request finished")
+    log.info("request finished")
     return ""
 
 
+def sync_pending_key(account_id: str) -> str:
+    return f"user:{account_id}, sync_pending"
+
+
+def enqueue_sync(account_id: str) -> None:
+    """Enqueue a job listing the account's new uploads, unless one is already
+    waiting in the queue"""
+    if not redis_client.set(
+        sync_pending_key(account_id), 1, nx=True, ex=config.sync_pending_ttl
+    ):
+        log.info(f"Sync already queued: {account_id}")
+        return
+    sync_queue.enqueue(sync_account, account_id, result_ttl=0)
+
+
+def sync_account(account_id: str) -> None:
+    """Run by the sync worker: list new uploads and enqueue a job for each"""
+    # any later webhook needs a new sync, as this one may list too early
+    redis_client.delete(sync_pending_key(account_id))
+    lock = redis_lock.Lock(redis_client, name=account_id, expire=60)
+    if not lock.acquire(blocking=False):
+        log.info(f"User request already being processed: {account_id}")
+        return
+    try:
+        enqueue_new_entries(account_id)
+    except Exception:
+        log.exception(f"Exception occured, when syncing account: {account_id}")
+    finally:
+        lock.release()
+        log.info(f"sync finished: {account_id}")
+
+
+def is_media_file(entry: dropbox.files.Metadata) -> bool:
+    # Ignore deleted files, folders
+    return entry.path_lower.endswith(config.media_extensions) and isinstance(
+        entry, dropbox.files.FileMetadata
+    )
+
+
 def dbx_list_entries(
     dbx: dropbox.Dropbox, path: Path
 ) -> t.Generator[dropbox.files.FileMetadata, None, None]:
@@ -146,11 +206,7 @@ def dbx_list_entries(
         log.info(f"Entries in upload folder: {len(result.entries)}")
         log.debug([entry.path_display for entry in result.entries])
         for entry in result.entries:
-            # Ignore deleted files, folders
-            if not (
-                entry.path_lower.endswith(config.media_extensions)
-                and isinstance(entry, dropbox.files.FileMetadata)
-            ):
+            if not is_media_file(entry):
                 continue
             yield entry
         # Repeat only if there's more to do
@@ -158,3 +214,43 @@ def dbx_list_entries(
             result = dbx.files_list_folder_continue(result.cursor)
         else:
             break
+
+
+def dbx_list_new_entries(
+    dbx: dropbox.Dropbox, account_id: str, path: Path
+) -> t.Tuple[t.List[dropbox.files.FileMetadata], str]:
+    """List entries added to path since the account's stored cursor, or all
+    entries if there is no cursor, Dropbox has reset it, or the last full listing
+    was more than full_listing_interval seconds ago. Returns the entries and the
+    new cursor, to be stored once the entries are handled"""
+    cursor, listed_at = redis_client.hmget(
+        f"user:{account_id}", "uploads_cursor", "uploads_listed_at"
+    )
+    # a full listing now and then picks up entries whose jobs were lost, e.g. with
+    # a killed worker
+    if (
+        listed_at is None
+        or time.time() - float(listed_at) > config.full_listing_interval
+    ):
+        cursor = None
+    if cursor is not None:
+        try:
+            result = dbx.files_list_folder_continue(cursor.decode())
+        except dropbox.exceptions.ApiError as exc:
+            log.info(f"List folder cursor reset: {account_id}, {exc.error}")
+        else:
+            entries: t.List[dropbox.files.FileMetadata] = []
+            while True:
+                entries.extend(
+                    entry for entry in result.entries if is_media_file(entry)
+                )
+                if not result.has_more:
+                    break
+                result = dbx.files_list_folder_continue(result.cursor)
+            log.info(f"New entries in upload folder: {len(entries)}")
+            return entries, result.cursor
+    # taken before listing, so nothing added meanwhile is missed by the next delta
+    cursor = dbx.files_list_folder_get_latest_cursor(path.as_posix()).cursor
+    redis_client.hset(f"user:{account_id}", "uploads_listed_at", time.time())
+    entries = list(dbx_list_entries(dbx, path))
+    return entries, cursor
@@ -1,22 +1,30 @@
 #! /usr/bin/env python3
 # coding: utf-8
 import datetime as dt
+import threading
+import time
 import typing as t
-from functools import partial
-from io import BytesIO
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from dataclasses import dataclass, field
+from functools import lru_cache, partial
 from pathlib import Path
 
 import dropbox
-import imagehash
 import pytz
 import redis
-import requests
-from PIL import Image
-from resizeimage import resizeimage
+import rq
 from timezonefinderL import TimezoneFinder
 
 from kamera import config, image_processing
 from kamera.logger import log
+from kamera.retry import RetryingDropbox
 
 seconds_in_fortnight = int(dt.timedelta(weeks=1).total_seconds())
 
@@ -27,7 +35,8 @@ class FoundBetterDuplicateException(Exception):
 
 class Task:
     dbx_cache: t.Dict[str, dropbox.Dropbox] = {}
-    settings_cache: t.Dict[str, config.Settings] = {}
+    settings_cache: "OrderedDict[str, config.Settings]" = OrderedDict()
+    folders_cache: t.Dict[str, "KnownFolders"] = {}
     redis_client: redis.Redis = None
 
     def __init__(
@@ -42,6 +51,7 @@ class Task:
         self.path: Path = Path(entry.path_display)
         self.name: str = self.path.name
         self.client_modified: dt.datetime = entry.client_modified
+        self.content_hash: t.Optional[str] = entry.content_hash
         self.review_dir: Path = review_dir
         self.backup_dir: Path = backup_dir
         self.error_dir: Path = error_dir
@@ -66,7 +76,11 @@ class Task:
         try:
             dbx = cls.dbx_cache[account_id]
         except KeyError:
-            dbx = dropbox.Dropbox(config.get_dbx_token(redis_client, account_id))
+            dbx = RetryingDropbox(
+                config.get_dbx_token(redis_client, account_id),
+                account_id=account_id,
+                redis_client=redis_client,
+            )
             cls.dbx_cache[account_id] = dbx
         return dbx
 
@@ -76,105 +90,532 @@ class Task:
     ) -> config.Settings:
         try:
             settings = cls.settings_cache[account_id]
-            log.debug("Settings loaded from cache")
         except KeyError:
             settings = config.Settings(dbx)
-            cls.settings_cache[account_id] = settings
             log.debug("Settings loaded from dbx")
+        else:
+            if (
+                time.monotonic() - settings.checked_at >= config.settings_ttl
+                and settings.refresh(dbx)
+            ):
+                log.debug("Settings reloaded from dbx")
+            else:
+                log.debug("Settings loaded from cache")
+        cls.settings_cache[account_id] = settings
+        cls.settings_cache.move_to_end(account_id)
+        while len(cls.settings_cache) > config.settings_cache_size:
+            cls.settings_cache.popitem(last=False)
         return settings
 
-    def main(self):
+    @classmethod
+    def load_folders_from_cache(
+        cls, account_id: str, dbx: dropbox.Dropbox
+    ) -> "KnownFolders":
         try:
-            redis_client = Task.connect_redis()
-            dbx = Task.load_dbx_from_cache(self.account_id, redis_client)
-            settings = Task.load_settings_from_cache(self.account_id, dbx)
-        except Exception:
-            log.exception("Exception occured during task setup")
-            return
-        self.process_entry(redis_client, dbx, settings)
+            known_folders = cls.folders_cache[account_id]
+        except KeyError:
+            known_folders = KnownFolders(
+                dbx, [config.review_path, config.backup_path, config.errors_path]
+            )
+            cls.folders_cache[account_id] = known_folders
+        return known_folders
 
-    def process_entry(
-        self, redis_client: redis.Redis, dbx: dropbox.Dropbox, settings: config.Settings
+    @property
+    def job_id(self) -> str:
+        return f"{self.account_id}:{self.name}"
+
+    def main(self):
+        TaskBatch(self.account_id, [self]).main()
+
+    def relocate(
+        self,
+        dbx: dropbox.Dropbox,
+        transfers: t.Optional["TransferBatcher"],
+        move_to: Path,
+        copy_to: t.Optional[Path] = None,
     ) -> None:
-        start_time = dt.datetime.now()
-        log.info(f"{self.name}: Processing")
+        """Copy entry (optionally) and move it, either now or as part of the next
+        batch of transfers"""
+        if transfers is not None:
+            transfers.add(self.path, move_to, copy_to, self.error_dir / self.name)
+            return
+        if copy_to is not None:
+            copy_entry(dbx, self.path, copy_to)
+        move_entry(dbx, self.path, move_to)
 
+    def prepare(
+        self,
+        redis_client: redis.Redis,
+        dbx: dropbox.Dropbox,
+        settings: config.Settings,
+        known_folders: t.Optional["KnownFolders"] = None,
+        transfers: t.Optional["TransferBatcher"] = None,
+    ) -> "Prepared":
+        """I/O before processing: metadata, destination folders, and the image data,
+        unless an identical image has been processed before"""
+        time_taken, dimensions, coordinates = parse_metdata(self.path, dbx)
+        date = parse_date(
+            time_taken, self.client_modified, coordinates, settings.default_tz
+        )
+        out_name = get_out_name(self.path.stem, self.path.suffix, date)
+        subfolder = Path(str(date.year), settings.folder_names[date.month])
+        review_path = self.review_dir / subfolder / out_name
+        backup_path = self.backup_dir / subfolder / self.name
+        if known_folders is not None:
+            known_folders.ensure([review_path.parent, backup_path.parent])
+
+        data = None
+        identical = None
+        if self.path.suffix.lower() in config.image_extensions:
+            identical = self.find_identical(redis_client, dbx, transfers)
+            if identical is None:
+                _, response = download_entry(dbx, self.path.as_posix())
+                data = response.raw.data
+        return Prepared(
+            date=date,
+            dimensions=dimensions,
+            coordinates=coordinates,
+            review_path=review_path,
+            backup_path=backup_path,
+            data=data,
+            identical=identical,
+        )
+
+    def find_identical(
+        self,
+        redis_client: redis.Redis,
+        dbx: dropbox.Dropbox,
+        transfers: t.Optional["TransferBatcher"] = None,
+    ) -> t.Optional[Path]:
+        """Return the review path of an image processed from identical contents,
+        if it's still in dbx, or about to be copied there"""
+        if self.content_hash is None:
+            return None
+        processed = get_processed(self.account_id, self.content_hash, redis_client)
+        if processed is None:
+            return None
+        img_hash, review_path = processed
+        # it may have been replaced by a better duplicate since
+        current_path = redis_client.get(hash_key(self.account_id, img_hash))
+        if current_path is not None:
+            review_path = Path(current_path.decode())
+        if transfers is not None and transfers.pending_copy(review_path) is not None:
+            return review_path
         try:
-            time_taken, dimensions, coordinates = parse_metdata(self.path, dbx)
-            date = parse_date(
-                time_taken, self.client_modified, coordinates, settings.default_tz
-            )
-            out_name = get_out_name(self.path.stem, self.path.suffix, date)
-            subfolder = Path(str(date.year), settings.folder_names[date.month])
-            review_path = self.review_dir / subfolder / out_name
-            backup_path = self.backup_dir / subfolder / self.name
+            dbx.files_get_metadata(review_path.as_posix())
+        except dropbox.exceptions.ApiError:
+            return None
+        return review_path
 
-            if self.path.suffix.lower() in config.video_extensions:
-                copy_entry(dbx, self.path, review_path)
-                move_entry(dbx, self.path, backup_path)
-                return
+    def process(
+        self, prepared: "Prepared", settings: config.Settings
+    ) -> image_processing.ProcessedImage:
+        if prepared.data is None:
+            raise ValueError(f"{self.name}: No image data to process")
+        return image_processing.main(
+            data=prepared.data,
+            filepath=self.path,
+            date=prepared.date,
+            settings=settings,
+            coordinates=prepared.coordinates,
+            dimensions=prepared.dimensions,
+        )
 
-            elif self.path.suffix.lower() not in config.image_extensions:
-                return
+    def store(
+        self,
+        prepared: "Prepared",
+        processed: t.Optional[image_processing.ProcessedImage],
+        redis_client: redis.Redis,
+        dbx: dropbox.Dropbox,
+        transfers: t.Optional["TransferBatcher"] = None,
+    ) -> None:
+        """I/O after processing: duplicate check, upload and moves. processed is
+        None for entries that aren't images, or were found identical to one"""
+        if prepared.identical is not None:
+            log.info(f"{self.name}: Identical to {prepared.identical}, finishing")
+            self.relocate(dbx, transfers, prepared.backup_path)
+            return
+        if processed is None:
+            if self.path.suffix.lower() in config.video_extensions:
+                self.relocate(
+                    dbx, transfers, prepared.backup_path, copy_to=prepared.review_path
+                )
+            return
 
-            _, response = download_entry(dbx, self.path.as_posix())
-            in_data = response.raw.data
-            new_data = image_processing.main(
-                data=in_data,
-                filepath=self.path,
-                date=date,
-                settings=settings,
-                coordinates=coordinates,
-                dimensions=dimensions,
+        handle_duplication(
+            account_id=self.account_id,
+            img_hash=processed.img_hash,
+            file_path=prepared.review_path,
+            dbx=dbx,
+            redis_client=redis_client,
+            dimensions=prepared.dimensions,
+            transfers=transfers,
+        )
+        if processed.data is None:
+            self.relocate(
+                dbx, transfers, prepared.backup_path, copy_to=prepared.review_path
             )
-
-            img_hash = get_hash(data=new_data if new_data is not None else in_data)
-            handle_duplication(
-                account_id_and_img_hash=f"user:{self.account_id}, hash:{img_hash}",
-                file_path=review_path,
-                dbx=dbx,
-                redis_client=redis_client,
-                dimensions=dimensions,
+        else:
+            upload_entry(dbx, processed.data, prepared.review_path)
+            self.relocate(dbx, transfers, prepared.backup_path)
+        if self.content_hash is not None:
+            set_processed(
+                self.account_id,
+                self.content_hash,
+                processed.img_hash,
+                prepared.review_path,
+                redis_client,
             )
 
-            if new_data is None:
-                copy_entry(dbx, self.path, review_path)
-            else:
-                upload_entry(dbx, new_data, review_path)
-
-            move_entry(dbx, self.path, backup_path)
-        except FoundBetterDuplicateException:
+    def handle_exception(
+        self,
+        exc: Exception,
+        prepared: t.Optional["Prepared"],
+        dbx: dropbox.Dropbox,
+        transfers: t.Optional["TransferBatcher"] = None,
+    ) -> bool:
+        """Move entry to backup if a better duplicate was found, otherwise to the
+        error folder. Returns False in the latter case"""
+        if isinstance(exc, FoundBetterDuplicateException) and prepared is not None:
             log.info(f"{self.name}: Found better duplicate, finishing")
-            move_entry(dbx, self.path, backup_path)
-        except Exception:
-            log.exception(f"Exception occured, moving to Error subfolder: {self.name}")
-            move_entry(dbx, self.path, (self.error_dir / self.name))
+            self.relocate(dbx, transfers, prepared.backup_path)
+            return True
+        log.error(
+            f"Exception occured, moving to Error subfolder: {self.name}", exc_info=exc
+        )
+        self.relocate(dbx, transfers, self.error_dir / self.name)
+        return False
+
+    def process_entry(
+        self,
+        redis_client: redis.Redis,
+        dbx: dropbox.Dropbox,
+        settings: config.Settings,
+        transfers: t.Optional["TransferBatcher"] = None,
+        known_folders: t.Optional["KnownFolders"] = None,
+    ) -> bool:
+        """Returns False if the entry was moved to the error folder"""
+        start_time = dt.datetime.now()
+        log.info(f"{self.name}: Processing")
+
+        prepared = None
+        try:
+            prepared = self.prepare(
+                redis_client, dbx, settings, known_folders, transfers
+            )
+            processed = (
+                self.process(prepared, settings) if prepared.data is not None else None
+            )
+            self.store(prepared, processed, redis_client, dbx, transfers)
+        except Exception as exc:
+            return self.handle_exception(exc, prepared, dbx, transfers)
         finally:
             end_time = dt.datetime.now()
             duration = end_time - start_time
             log.info(f"{self.name}, duration: {duration}")
             log.info("\n")
+        return True
+
+
+@dataclass(frozen=True)
+class Prepared:
+    """Entry as fetched for processing. data is None unless it's an image, and
+    identical is the review path of an image with the same contents, if any"""
+
+    date: dt.datetime
+    dimensions: t.Optional[dropbox.files.Dimensions]
+    coordinates: t.Optional[dropbox.files.GpsCoordinates]
+    review_path: Path
+    backup_path: Path
+    data: t.Optional[bytes]
+    identical: t.Optional[Path] = None
+
+
+_pipeline_settings: t.Optional[config.Settings] = None
+
+
+def _set_pipeline_settings(settings: config.Settings) -> None:
+    global _pipeline_settings
+    _pipeline_settings = settings
+
+
+def _process_in_pipeline(
+    task: Task, prepared: Prepared
+) -> image_processing.ProcessedImage:
+    if _pipeline_settings is None:
+        raise RuntimeError("Pipeline process started without settings")
+    return task.process(prepared, _pipeline_settings)
+
+
+class TaskBatch:
+    """Entries of one account, processed in a single job sharing one setup"""
+
+    # worker processes sharing the machine's CPUs, set by run_prefork
+    worker_processes: int = 1
+
+    def __init__(self, account_id: str, tasks: t.List[Task]) -> None:
+        self.account_id = account_id
+        self.tasks = tasks
+
+    def __repr__(self):
+        return repr(self.tasks)
+
+    @property
+    def job_id(self) -> str:
+        if len(self.tasks) == 1:
+            return self.tasks[0].job_id
+        return f"{self.tasks[0].job_id}+{len(self.tasks) - 1}"
+
+    def cpu_workers(self) -> int:
+        """Processes for the pipeline: no more than there are entries, and a share
+        of pipeline_cpu_workers per worker process"""
+        share = max(1, config.pipeline_cpu_workers // self.worker_processes)
+        return min(len(self.tasks), share)
+
+    def main(self) -> t.Dict[str, str]:
+        """Process each entry, and return its result: "done", "error" if it was
+        moved to the error folder, or "failed" if it couldn't be handled. Results
+        so far are kept in the job's meta, as the job progresses. If any entry is
+        left unhandled, the next sync lists the whole uploads folder again."""
+        redis_client = Task.connect_redis()
+        job_ids = [task.job_id for task in self.tasks]
+        start_jobs(self.account_id, job_ids, redis_client)
+        job = rq.get_current_job()
+        results: t.Dict[str, str] = {}
+        complete = False
+        try:
+            try:
+                dbx = Task.load_dbx_from_cache(self.account_id, redis_client)
+                settings = Task.load_settings_from_cache(self.account_id, dbx)
+                known_folders = Task.load_folders_from_cache(self.account_id, dbx)
+            except Exception:
+                log.exception("Exception occured during task setup")
+                results.update({task.name: "failed" for task in self.tasks})
+                return results
+            transfers = TransferBatcher(dbx)
+            if len(self.tasks) > 1 and config.pipeline_cpu_workers > 0:
+
+                def finish(task: Task, result: str) -> None:
+                    results[task.name] = result
+                    save_results(job, results)
+
+                stats = run_pipeline(
+                    self.tasks,
+                    redis_client,
+                    dbx,
+                    settings,
+                    known_folders,
+                    on_result=finish,
+                    transfers=transfers,
+                    io_workers=config.pipeline_io_workers,
+                    cpu_workers=self.cpu_workers(),
+                    window=config.pipeline_window,
+                )
+                log.info(stats.summary())
+            else:
+                for task in self.tasks:
+                    try:
+                        ok = task.process_entry(
+                            redis_client, dbx, settings, transfers, known_folders
+                        )
+                        results[task.name] = "done" if ok else "error"
+                    except Exception:
+                        log.exception(f"Exception occured, processing: {task.name}")
+                        results[task.name] = "failed"
+                    save_results(job, results)
+            transfers.flush()
+            for transfer in transfers.results:
+                if transfer.to_path is None:
+                    results[transfer.from_path.name] = "failed"
+                elif transfer.error:
+                    # copy or move failed after processing
+                    results[transfer.from_path.name] = "error"
+            save_results(job, results)
+            complete = True
+        finally:
+            remove_jobs(self.account_id, job_ids, redis_client)
+            # also on exceptions, such as the job timing out
+            if not complete or "failed" in results.values():
+                reset_uploads_cursor(self.account_id, redis_client)
+        return results
+
+
+@dataclass
+class PipelineStats:
+    """Entries per result, and seconds spent in each stage summed over entries"""
+
+    results: t.Counter[str] = field(default_factory=Counter)
+    stage_seconds: t.DefaultDict[str, float] = field(
+        default_factory=partial(defaultdict, float)
+    )
+    stage_entries: t.Counter[str] = field(default_factory=Counter)
+    started_at: float = field(default_factory=time.monotonic)
+
+    def add_stage(self, stage: str, seconds: float) -> None:
+        self.stage_seconds[stage] += seconds
+        self.stage_entries[stage] += 1
+
+    def summary(self) -> str:
+        elapsed = time.monotonic() - self.started_at
+        n_entries = sum(self.results.values())
+        lines = [
+            f"Processed {n_entries} entries in {elapsed:.1f}s"
+            f" ({n_entries / max(elapsed, 1e-9):.2f} entries/s)",
+            "Results: "
+            + ", ".join(f"{result}: {n}" for result, n in sorted(self.results.items())),
+        ]
+        for stage in ["prepare", "process", "store"]:
+            if self.stage_entries[stage]:
+                seconds = self.stage_seconds[stage]
+                average = seconds / self.stage_entries[stage]
+                lines.append(f"{stage}: {seconds:.1f}s, {average:.3f}s per entry")
+        return "\n".join(lines)
+
+
+def _timed(func: t.Callable, *args) -> t.Tuple[t.Any, float]:
+    start_time = time.monotonic()
+    value = func(*args)
+    return value, time.monotonic() - start_time
+
+
+def run_pipeline(
+    tasks: t.Iterable[Task],
+    redis_client: redis.Redis,
+    dbx: dropbox.Dropbox,
+    settings: config.Settings,
+    known_folders: t.Optional["KnownFolders"],
+    on_result: t.Callable[[Task, str], None],
+    transfers: t.Optional["TransferBatcher"] = None,
+    io_workers: int = config.pipeline_io_workers,
+    cpu_workers: int = config.pipeline_cpu_workers,
+    window: int = config.pipeline_window,
+) -> PipelineStats:
+    """Process entries in overlapping stages: metadata and downloads in one thread
+    pool, image processing in a process pool, and duplicate checks, uploads and
+    moves in another thread pool. Tasks are taken from tasks as they are needed,
+    and at most window entries are in flight at once, which caps the image data
+    held in memory. on_result is called with each entry's result: "done",
+    "error" if it was moved to the error folder, or "failed" if it couldn't be
+    handled."""
+    stats = PipelineStats()
+    pending = iter(tasks)
+    in_flight: t.Dict[Future, t.Tuple[str, Task, t.Optional[Prepared]]] = {}
+
+    def finish(task: Task, result: str) -> None:
+        stats.results[result] += 1
+        on_result(task, result)
+
+    with ProcessPoolExecutor(
+        cpu_workers, initializer=_set_pipeline_settings, initargs=(settings,)
+    ) as cpu_pool:
+        # start the processes before any threads, forking while other threads
+        # hold locks can deadlock the children. Python 3.7 starts all of them with
+        # the first task, later versions one per task submitted while none is idle
+        warm_up = [cpu_pool.submit(time.sleep, 0.1) for _ in range(cpu_workers)]
+        wait(warm_up)
+        fetch_pool = ThreadPoolExecutor(io_workers)
+        store_pool = ThreadPoolExecutor(io_workers)
+        with fetch_pool, store_pool:
+            while True:
+                while len(in_flight) < window:
+                    task = next(pending, None)
+                    if task is None:
+                        break
+                    log.info(f"{task.name}: Processing")
+                    future = fetch_pool.submit(
+                        _timed,
+                        task.prepare,
+                        redis_client,
+                        dbx,
+                        settings,
+                        known_folders,
+                        transfers,
+                    )
+                    in_flight[future] = ("prepare", task, None)
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, task, prepared = in_flight.pop(future)
+                    try:
+                        value, seconds = future.result()
+                    except Exception as exc:
+                        try:
+                            ok = task.handle_exception(exc, prepared, dbx, transfers)
+                            finish(task, "done" if ok else "error")
+                        except Exception:
+                            log.exception(f"Exception occured, processing: {task.name}")
+                            finish(task, "failed")
+                        continue
+                    stats.add_stage(stage, seconds)
+                    if stage == "store":
+                        finish(task, "done")
+                        continue
+                    if stage == "prepare":
+                        prepared = value
+                        if prepared.data is not None:
+                            future = cpu_pool.submit(
+                                _timed, _process_in_pipeline, task, prepared
+                            )
+                            in_flight[future] = ("process", task, prepared)
+                            continue
+                        processed = None
+                    else:
+                        processed = value
+                    future = store_pool.submit(
+                        _timed,
+                        task.store,
+                        prepared,
+                        processed,
+                        redis_client,
+                        dbx,
+                        transfers,
+                    )
+                    in_flight[future] = ("store", task, prepared)
+    return stats
+
+
+def save_results(job: t.Optional[rq.job.Job], results: t.Dict[str, str]) -> None:
+    if job is not None:
+        job.meta["results"] = results
+        job.save_meta()
+
+
+def batch_size(n_entries: int) -> int:
+    """Entries per job: one while the backlog is small, more as it grows, so that
+    it's split into about batch_target_jobs jobs of at most batch_max_size"""
+    size = -(-n_entries // config.batch_target_jobs)
+    return max(1, min(config.batch_max_size, size))
 
 
 def handle_duplication(
-    account_id_and_img_hash: str,
+    account_id: str,
+    img_hash: str,
     file_path: Path,
     dbx: dropbox.Dropbox,
     redis_client: redis.Redis,
     dimensions: dropbox.files.Dimensions,
+    transfers: t.Optional["TransferBatcher"] = None,
 ) -> None:
-    dup_file_path = redis_client.get(account_id_and_img_hash)
-    # need to check for duplicate before storing the hash
-    store_hash(account_id_and_img_hash, file_path, redis_client)
-    if dup_file_path is None:
+    duplicate = claim_hash(account_id, img_hash, file_path, redis_client)
+    if duplicate is None:
         return
-    dup_file_path = dup_file_path.decode()
+    dup_hash, dup_file_path = duplicate
 
+    # the duplicate may not have been copied to its path yet, in which case its
+    # source is looked at instead
+    pending = (
+        transfers.pending_copy(Path(dup_file_path)) if transfers is not None else None
+    )
     try:
-        dup_entry = dbx.files_get_metadata(dup_file_path, include_media_info=True)
+        dup_entry = dbx.files_get_metadata(
+            pending.from_path.as_posix() if pending is not None else dup_file_path,
+            include_media_info=True,
+        )
     except dropbox.exceptions.ApiError:
         log.info("Duplicate hash found, but image not in dbx")
-        delete_hash(account_id_and_img_hash, redis_client)
+        if dup_hash != img_hash:
+            delete_hash(account_id, dup_hash, redis_client)
         return
     dup_metadata = dup_entry.media_info.get_metadata() if dup_entry.media_info else None
     try:
@@ -188,30 +629,203 @@ def handle_duplication(
     if duplicate_better:
         raise FoundBetterDuplicateException
     else:
-        log.info(f"Found worse duplicate, deleting: {dup_entry.path_display}")
-        delete_entry(dup_entry, dbx)
-        delete_hash(account_id_and_img_hash, redis_client)
+        log.info(f"Found worse duplicate, deleting: {dup_file_path}")
+        if pending is not None and transfers is not None:
+            transfers.cancel_copy(pending)
+        else:
+            delete_entry(dup_entry, dbx)
+        if dup_hash != img_hash:
+            delete_hash(account_id, dup_hash, redis_client)
 
 
-def get_hash(data: bytes) -> str:
-    img = Image.open(BytesIO(data))
-    if img.height > 500:
-        small_img = resizeimage.resize_height(img, size=500)
-    else:
-        small_img = img
-    img_hash = imagehash.whash(small_img)
-    return img_hash
+def jobs_key(account_id: str) -> str:
+    return f"user:{account_id}, jobs"
+
+
+def add_jobs(account_id: str, job_ids: t.List[str], redis_client: redis.Redis) -> None:
+    """Index queued jobs. They are kept until they start, however long they wait"""
+    redis_client.zadd(
+        jobs_key(account_id), {job_id: float("inf") for job_id in job_ids}
+    )
 
 
-def store_hash(
-    account_id_and_img_hash: str, file_path: Path, redis_client: redis.Redis
+def start_jobs(
+    account_id: str, job_ids: t.List[str], redis_client: redis.Redis
 ) -> None:
-    redis_client.set(account_id_and_img_hash, file_path.as_posix())
-    redis_client.expire(account_id_and_img_hash, seconds_in_fortnight)
+    """Mark jobs as running. They are taken to have died without being removed
+    once they have run longer than the job timeout of a batch of their size"""
+    deadline = time.time() + config.entry_timeout * len(job_ids)
+    redis_client.zadd(jobs_key(account_id), {job_id: deadline for job_id in job_ids})
+
+
+def remove_jobs(
+    account_id: str, job_ids: t.List[str], redis_client: redis.Redis
+) -> None:
+    redis_client.zrem(jobs_key(account_id), *job_ids)
+
+
+def get_jobs(account_id: str, redis_client: redis.Redis) -> t.Set[str]:
+    """Return IDs of the account's queued and running jobs, dropping running jobs
+    that are past their deadline"""
+    key = jobs_key(account_id)
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.zremrangebyscore(key, "-inf", time.time())
+    pipe.zrange(key, 0, -1)
+    _, job_ids = pipe.execute()
+    return {job_id.decode() for job_id in job_ids}
+
+
+def reset_uploads_cursor(account_id: str, redis_client: redis.Redis) -> None:
+    """Drop the account's stored list_folder cursor, so that entries left in the
+    uploads folder are found by the next full listing"""
+    log.info(f"Resetting uploads cursor: {account_id}")
+    redis_client.hdel(f"user:{account_id}", "uploads_cursor")
+
+
+def hash_key(account_id: str, img_hash: str) -> str:
+    return f"user:{account_id}, hash:{img_hash}"
+
+
+def hash_chunks(img_hash: str, n_chunks: int) -> t.List[str]:
+    """Split hash into n_chunks bit substrings. If two hashes are within
+    n_chunks - 1 bits of each other, at least one of their chunks is identical."""
+    n_bits = len(img_hash) * 4
+    bits = bin(int(img_hash, 16))[2:].zfill(n_bits)
+    bounds = [n_bits * i // n_chunks for i in range(n_chunks + 1)]
+    return [bits[start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+def hash_chunk_keys(account_id: str, img_hash: str) -> t.List[str]:
+    n_chunks = config.duplicate_hash_distance + 1
+    return [
+        f"user:{account_id}, hash_chunk:{n_chunks}.{i}:{chunk}"
+        for i, chunk in enumerate(hash_chunks(img_hash, n_chunks))
+    ]
+
+
+# KEYS: hash key of img_hash, then its chunk keys
+# ARGV: img_hash, file path, ttl, max distance, hash key prefix
+# Returns {duplicate hash, duplicate file path} or nil
+# Reads the hash keys of candidates found in the chunk sets, which can't be
+# declared in KEYS up front. All keys of an account must then be on one node, so
+# this needs a single Redis server rather than Redis Cluster.
+claim_hash_script = """
+local img_hash = ARGV[1]
+local max_distance = tonumber(ARGV[4])
+local prefix = ARGV[5]
+
+local function hamming_distance(hash1, hash2)
+    local distance = 0
+    for i = 1, #hash1 do
+        local a = tonumber(hash1:sub(i, i), 16)
+        local b = tonumber(hash2:sub(i, i), 16)
+        for _ = 1, 4 do
+            if a % 2 ~= b % 2 then
+                distance = distance + 1
+            end
+            a = math.floor(a / 2)
+            b = math.floor(b / 2)
+        end
+    end
+    return distance
+end
+
+local candidates = {[img_hash] = true}
+for i = 2, #KEYS do
+    for _, member in ipairs(redis.call("SMEMBERS", KEYS[i])) do
+        candidates[member] = true
+    end
+end
 
+local best_hash, best_path, best_distance = false, false, max_distance + 1
+for candidate in pairs(candidates) do
+    local path = redis.call("GET", prefix .. candidate)
+    if not path then
+        -- its hash key expired. The chunk sets are refreshed by every new
+        -- member and would keep it, so drop it from those read here
+        for i = 2, #KEYS do
+            redis.call("SREM", KEYS[i], candidate)
+        end
+    elseif #candidate == #img_hash then
+        local distance = hamming_distance(img_hash, candidate)
+        if distance <= max_distance and (distance < best_distance
+            or (distance == best_distance and candidate < best_hash)) then
+            best_hash, best_path, best_distance = candidate, path, distance
+        end
+    end
+end
 
-def delete_hash(account_id_and_img_hash: str, redis_client: redis.Redis) -> None:
-    redis_client.delete(account_id_and_img_hash)
+redis.call("SET", KEYS[1], ARGV[2], "EX", ARGV[3])
+for i = 2, #KEYS do
+    redis.call("SADD", KEYS[i], img_hash)
+    redis.call("EXPIRE", KEYS[i], ARGV[3])
+end
+if best_hash then
+    return {best_hash, best_path}
+end
+return false
+"""
+
+
+def claim_hash(
+    account_id: str, img_hash: str, file_path: Path, redis_client: redis.Redis
+) -> t.Optional[t.Tuple[str, str]]:
+    """Store hash for file_path, and return the closest previously stored hash
+    within duplicate_hash_distance bits with its file path, if any. Runs as one
+    Lua script, so concurrent duplicates resolve in order, in one round trip."""
+    script = redis_client.register_script(claim_hash_script)
+    result = script(
+        keys=[hash_key(account_id, img_hash)] + hash_chunk_keys(account_id, img_hash),
+        args=[
+            img_hash,
+            file_path.as_posix(),
+            seconds_in_fortnight,
+            config.duplicate_hash_distance,
+            hash_key(account_id, ""),
+        ],
+    )
+    if not result:
+        return None
+    dup_hash, dup_file_path = (value.decode() for value in result)
+    return dup_hash, dup_file_path
+
+
+def content_hash_key(account_id: str, content_hash: str) -> str:
+    return f"user:{account_id}, content_hash:{content_hash}"
+
+
+def get_processed(
+    account_id: str, content_hash: str, redis_client: redis.Redis
+) -> t.Optional[t.Tuple[str, Path]]:
+    """Return image hash and review path of the image processed from a file with
+    Dropbox content_hash, if any"""
+    value = redis_client.get(content_hash_key(account_id, content_hash))
+    if value is None:
+        return None
+    img_hash, review_path = value.decode().split(" ", 1)
+    return img_hash, Path(review_path)
+
+
+def set_processed(
+    account_id: str,
+    content_hash: str,
+    img_hash: str,
+    review_path: Path,
+    redis_client: redis.Redis,
+) -> None:
+    redis_client.set(
+        content_hash_key(account_id, content_hash),
+        f"{img_hash} {review_path.as_posix()}",
+        ex=seconds_in_fortnight,
+    )
+
+
+def delete_hash(account_id: str, img_hash: str, redis_client: redis.Redis) -> None:
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.delete(hash_key(account_id, img_hash))
+    for chunk_key in hash_chunk_keys(account_id, img_hash):
+        pipe.srem(chunk_key, img_hash)
+    pipe.execute()
 
 
 def delete_entry(entry: dropbox.files.FileMetadata, dbx: dropbox.Dropbox) -> None:
@@ -223,9 +837,6 @@ def _execute_transfer(
 ) -> None:
     try:
         transfer_func()
-    except requests.exceptions.SSLError:
-        log.info("Encountered SSL error during transfer. Trying again")
-        transfer_func()
     except dropbox.exceptions.BadInputError:
         log.info(f"Making folder: {destination_folder}")
         dbx.files_create_folder(destination_folder.as_posix())
@@ -262,12 +873,290 @@ def upload_entry(dbx: dropbox.Dropbox, new_data: bytes, to_path: Path) -> None:
     _execute_transfer(dbx, transfer_func, to_path.parent)
 
 
+class KnownFolders:
+    """Folders known to exist under the given roots, listed in bulk and refreshed
+    after ttl seconds, so missing folders can be created before transferring
+    instead of after a failed transfer"""
+
+    def __init__(
+        self,
+        dbx: dropbox.Dropbox,
+        roots: t.List[Path],
+        ttl: int = config.folder_cache_ttl,
+        poll_interval: float = 1.0,
+    ) -> None:
+        self.dbx = dbx
+        self.roots = roots
+        self.ttl = dt.timedelta(seconds=ttl)
+        self.poll_interval = poll_interval
+        self.folders: t.Set[str] = set()
+        self.refreshed_at: t.Optional[dt.datetime] = None
+        self.lock = threading.Lock()
+
+    def _list_folders(self, path: str) -> t.List[dropbox.files.FolderMetadata]:
+        result = self.dbx.files_list_folder(path)
+        folders: t.List[dropbox.files.FolderMetadata] = []
+        while True:
+            folders.extend(
+                entry
+                for entry in result.entries
+                if isinstance(entry, dropbox.files.FolderMetadata)
+            )
+            if not result.has_more:
+                return folders
+            result = self.dbx.files_list_folder_continue(result.cursor)
+
+    def refresh(self) -> None:
+        """List the year folders of each root and the month folders of each
+        year, which is as deep as files are moved to. Recursive listings would
+        also return every event folder and grow with the archive"""
+        folders = set()
+        for root in self.roots:
+            try:
+                years = self._list_folders(root.as_posix())
+            except dropbox.exceptions.ApiError:
+                log.info(f"Unable to list folder: {root}")
+                continue
+            folders.add(root.as_posix().lower())
+            folders.update(year.path_lower for year in years)
+            for year in years:
+                try:
+                    months = self._list_folders(year.path_display)
+                except dropbox.exceptions.ApiError:
+                    log.info(f"Unable to list folder: {year.path_display}")
+                    continue
+                folders.update(month.path_lower for month in months)
+        self.folders = folders
+        self.refreshed_at = dt.datetime.now()
+        log.debug(f"Known folders: {len(folders)}")
+
+    def _add(self, folder: Path) -> None:
+        self.folders.add(folder.as_posix().lower())
+        self.folders.update(parent.as_posix().lower() for parent in folder.parents)
+
+    def ensure(self, folders: t.Iterable[Path]) -> None:
+        """Create those of folders that don't exist, in one batch. Safe to call
+        from several threads"""
+        with self.lock:
+            self._ensure(folders)
+
+    def _ensure(self, folders: t.Iterable[Path]) -> None:
+        if (
+            self.refreshed_at is None
+            or dt.datetime.now() - self.refreshed_at > self.ttl
+        ):
+            self.refresh()
+        missing = {
+            folder
+            for folder in folders
+            if folder.as_posix().lower() not in self.folders
+        }
+        # parent folders are created along with their subfolders
+        missing = {
+            folder
+            for folder in missing
+            if not any(folder in other.parents for other in missing)
+        }
+        if not missing:
+            return
+        paths = sorted(folder.as_posix() for folder in missing)
+        log.info(f"Making folders: {paths}")
+        launch = self.dbx.files_create_folder_batch(paths, autorename=False)
+        if launch.is_complete():
+            result = launch.get_complete()
+        else:
+            job_id = launch.get_async_job_id()
+            status = self.dbx.files_create_folder_batch_check(job_id)
+            while status.is_in_progress():
+                time.sleep(self.poll_interval)
+                status = self.dbx.files_create_folder_batch_check(job_id)
+            if not status.is_complete():
+                log.info("Unable to make folders")
+                return
+            result = status.get_complete()
+        for path, entry in zip(paths, result.entries):
+            if entry.is_success() or (
+                entry.get_failure().is_path()
+                and entry.get_failure().get_path().is_conflict()
+            ):
+                self._add(Path(path))
+
+
+@dataclass
+class Transfer:
+    from_path: Path
+    move_to: Path
+    copy_to: t.Optional[Path]
+    error_path: Path
+
+
+@dataclass(frozen=True)
+class TransferResult:
+    from_path: Path
+    to_path: t.Optional[Path]  # None if entry could not be moved
+    copied_to: t.Optional[Path]
+    error_path: Path
+
+    @property
+    def error(self) -> bool:
+        return self.to_path == self.error_path
+
+
+class TransferBatcher:
+    """Collects copies and moves from many tasks for one account, and submits them
+    with the batch endpoints. Entries that fail in a batch are retried one by one,
+    and moved to the error folder if that fails too."""
+
+    max_batch_size = 1000  # Dropbox limit
+
+    def __init__(self, dbx: dropbox.Dropbox, poll_interval: float = 1.0) -> None:
+        self.dbx = dbx
+        self.poll_interval = poll_interval
+        self.pending: t.List[Transfer] = []
+        self.copies: t.Dict[str, Transfer] = {}
+        self.moves: t.Dict[Path, Transfer] = {}
+        self.results: t.List[TransferResult] = []
+        self.lock = threading.Lock()
+
+    def add(
+        self,
+        from_path: Path,
+        move_to: Path,
+        copy_to: t.Optional[Path],
+        error_path: Path,
+    ) -> None:
+        transfer = Transfer(from_path, move_to, copy_to, error_path)
+        with self.lock:
+            self.pending.append(transfer)
+            self.moves[from_path] = transfer
+            if copy_to is not None:
+                self.copies[copy_to.as_posix().lower()] = transfer
+            full = len(self.pending) >= self.max_batch_size
+        if full:
+            self.flush()
+
+    def pending_transfer(self, from_path: Path) -> t.Optional[Transfer]:
+        """Return the pending transfer of the entry at from_path, if any"""
+        with self.lock:
+            return self.moves.get(from_path)
+
+    def pending_copy(self, to_path: Path) -> t.Optional[Transfer]:
+        """Return the pending transfer that copies an entry to to_path, if any"""
+        with self.lock:
+            return self.copies.get(to_path.as_posix().lower())
+
+    def cancel_copy(self, transfer: Transfer) -> None:
+        """Only move the entry of a pending transfer, without copying it"""
+        with self.lock:
+            if transfer.copy_to is not None:
+                self.copies.pop(transfer.copy_to.as_posix().lower(), None)
+                transfer.copy_to = None
+
+    def _run_batch(
+        self,
+        batch_func: t.Callable,
+        check_func: t.Callable,
+        paths: t.List[t.Tuple[Path, Path]],
+    ) -> t.List[bool]:
+        """Submit relocations, wait for the batch job, and return success per entry"""
+        if not paths:
+            return []
+        entries = [
+            dropbox.files.RelocationPath(
+                from_path=from_path.as_posix(), to_path=to_path.as_posix()
+            )
+            for from_path, to_path in paths
+        ]
+        # entries of a failed batch are transferred one by one
+        failed = [False] * len(paths)
+        try:
+            launch = batch_func(entries=entries, autorename=True)
+            if launch.is_complete():
+                result = launch.get_complete()
+            elif launch.is_async_job_id():
+                job_id = launch.get_async_job_id()
+                status = check_func(job_id)
+                while status.is_in_progress():
+                    time.sleep(self.poll_interval)
+                    status = check_func(job_id)
+                if not status.is_complete():
+                    log.info("Batch job failed")
+                    return failed
+                result = status.get_complete()
+            else:
+                log.info("Unable to start batch job")
+                return failed
+        except dropbox.exceptions.ApiError:
+            log.exception("Unable to run batch job")
+            return failed
+        return [entry.is_success() for entry in result.entries]
+
+    def _copy(self, transfers: t.List[Transfer]) -> None:
+        copies = [
+            (transfer, transfer.copy_to)
+            for transfer in transfers
+            if transfer.copy_to is not None
+        ]
+        log.info(f"Copying batch of {len(copies)} entries")
+        succeeded = self._run_batch(
+            self.dbx.files_copy_batch_v2,
+            self.dbx.files_copy_batch_check_v2,
+            [(transfer.from_path, copy_to) for transfer, copy_to in copies],
+        )
+        for (transfer, copy_to), success in zip(copies, succeeded):
+            if success:
+                continue
+            try:
+                copy_entry(self.dbx, transfer.from_path, copy_to)
+            except Exception:
+                log.exception(f"Copy failed, moving to Error: {transfer.from_path}")
+                transfer.move_to = transfer.error_path
+                transfer.copy_to = None
+
+    def _move(self, transfers: t.List[Transfer]) -> t.List[TransferResult]:
+        log.info(f"Moving batch of {len(transfers)} entries")
+        succeeded = self._run_batch(
+            self.dbx.files_move_batch_v2,
+            self.dbx.files_move_batch_check_v2,
+            [(transfer.from_path, transfer.move_to) for transfer in transfers],
+        )
+        results = []
+        for transfer, success in zip(transfers, succeeded):
+            to_path: t.Optional[Path] = transfer.move_to
+            if not success:
+                try:
+                    move_entry(self.dbx, transfer.from_path, transfer.move_to)
+                except Exception:
+                    log.exception(f"Move failed, moving to Error: {transfer.from_path}")
+                    to_path = transfer.error_path
+                    try:
+                        move_entry(self.dbx, transfer.from_path, to_path)
+                    except Exception:
+                        log.exception(f"Unable to move: {transfer.from_path}")
+                        to_path = None
+            results.append(
+                TransferResult(
+                    transfer.from_path, to_path, transfer.copy_to, transfer.error_path
+                )
+            )
+        return results
+
+    def flush(self) -> t.List[TransferResult]:
+        """Execute pending transfers. Copies run first, since they read from the
+        paths that are moved afterwards."""
+        with self.lock:
+            transfers, self.pending = self.pending, []
+            self.copies = {}
+            self.moves = {}
+        self._copy(transfers)
+        results = self._move(transfers)
+        with self.lock:
+            self.results.extend(results)
+        return results
+
+
 def download_entry(dbx, path_str: str):
-    try:
-        return dbx.files_download(path_str)
-    except requests.exceptions.SSLError:
-        log.info("Encountered SSL error during transfer. Trying again")
-        return dbx.files_download(path_str)
+    return dbx.files_download(path_str)
 
 
 def parse_metdata(
@@ -300,16 +1189,45 @@ def parse_date(
     naive_date = time_taken if time_taken is not None else client_modified
     utc_date = naive_date.replace(tzinfo=dt.timezone.utc)
     if coordinates is not None:
-        img_tz = TimezoneFinder().timezone_at(
+        img_tz = get_timezone_resolver().timezone_at(
             lat=coordinates.latitude, lng=coordinates.longitude
         )
         if img_tz:
-            local_date = utc_date.astimezone(tz=pytz.timezone(img_tz))
+            local_date = utc_date.astimezone(tz=get_tz(img_tz))
             return local_date
-    local_date = utc_date.astimezone(tz=pytz.timezone(default_tz))
+    local_date = utc_date.astimezone(tz=get_tz(default_tz))
     return local_date
 
 
+class TimezoneResolver:
+    """Timezone lookup with an LRU cache keyed on coordinates rounded to
+    `precision` decimals, so photos taken close together share a lookup"""
+
+    def __init__(self, precision: int, cache_size: int) -> None:
+        self.precision = precision
+        self.finder = TimezoneFinder()
+        self._cached_timezone_at = lru_cache(maxsize=cache_size)(self._timezone_at)
+
+    def _timezone_at(self, lat: float, lng: float) -> t.Optional[str]:
+        return self.finder.timezone_at(lat=lat, lng=lng)
+
+    def timezone_at(self, lat: float, lng: float) -> t.Optional[str]:
+        return self._cached_timezone_at(
+            round(lat, self.precision), round(lng, self.precision)
+        )
+
+
+@lru_cache(maxsize=None)
+def get_timezone_resolver() -> TimezoneResolver:
+    """Return the timezone resolver of the current worker process"""
+    return TimezoneResolver(config.timezone_precision, config.timezone_cache_size)
+
+
+@lru_cache(maxsize=None)
+def get_tz(name: str) -> dt.tzinfo:
+    return pytz.timezone(name)
+
+
 def get_out_name(stem: str, suffix: str, date: dt.datetime) -> str:
     date_format_in1 = date.strftime("_%Y%m%d_%H%M%S")
     date_format_in2 = date.strftime(" %Y-%m-%d %H_%M_%S")
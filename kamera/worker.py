@@ -0,0 +1,122 @@
+#! /usr/bin/env python3
+# coding: utf-8
+import gc
+import os
+import resource
+import signal
+import time
+import typing as t
+
+import rq
+
+from kamera import task
+from kamera.logger import log
+
+
+class RecyclingWorker(rq.SimpleWorker):
+    """Worker that runs jobs in its own process, and stops once it has run max_jobs
+    jobs or its peak memory use exceeds max_memory_mb, to be replaced by a fresh
+    process"""
+
+    def __init__(
+        self,
+        *args,
+        max_jobs: t.Optional[int] = None,
+        max_memory_mb: t.Optional[int] = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.max_jobs = max_jobs
+        self.max_memory_mb = max_memory_mb
+        self.jobs_executed = 0
+
+    def execute_job(self, *args, **kwargs):
+        result = super().execute_job(*args, **kwargs)
+        self.jobs_executed += 1
+        if self.max_jobs is not None and self.jobs_executed >= self.max_jobs:
+            log.info(f"Worker {os.getpid()}: ran {self.jobs_executed} jobs, stopping")
+            self._stop_requested = True
+        if self.max_memory_mb is not None and memory_mb() > self.max_memory_mb:
+            log.info(f"Worker {os.getpid()}: using {memory_mb():.0f} MB, stopping")
+            self._stop_requested = True
+        return result
+
+
+def memory_mb() -> float:
+    # peak resident set size, in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def preload() -> None:
+    """Load what jobs need before forking, so children share it copy-on-write.
+    face_recognition loads dlib's models when imported, along with kamera.config"""
+    task.get_timezone_resolver().timezone_at(lat=0.0, lng=0.0)
+    gc.collect()
+    # keep the collector from touching, and so copying, the preloaded objects
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+
+
+def run_prefork(
+    queues: t.List[rq.Queue],
+    concurrency: int,
+    max_jobs: t.Optional[int] = None,
+    max_memory_mb: t.Optional[int] = None,
+) -> None:
+    """Fork concurrency worker processes pulling from queues, and replace each one
+    that exits until asked to stop"""
+    preload()
+    task.TaskBatch.worker_processes = concurrency
+    children: t.Set[int] = set()
+    stopping = False
+
+    def stop(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while True:
+        while not stopping and len(children) < concurrency:
+            pid = os.fork()
+            if pid == 0:
+                _run_child(queues, max_jobs, max_memory_mb)
+            log.info(f"Started worker process: {pid}")
+            children.add(pid)
+        if not children:
+            break
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        log.info(f"Worker process {pid} exited, status: {status}")
+        if status != 0 and not stopping:
+            # don't respawn in a tight loop if children keep crashing
+            time.sleep(1)
+
+
+def _run_child(
+    queues: t.List[rq.Queue],
+    max_jobs: t.Optional[int],
+    max_memory_mb: t.Optional[int],
+) -> t.NoReturn:
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    exit_code = 0
+    try:
+        worker = RecyclingWorker(
+            queues,
+            connection=queues[0].connection,
+            max_jobs=max_jobs,
+            max_memory_mb=max_memory_mb,
+        )
+        worker.work()
+    except Exception:
+        log.exception("Exception in worker process")
+        exit_code = 1
+    finally:
+        os._exit(exit_code)
@@ -0,0 +1,161 @@
+#! /usr/bin/env python3
+# coding: utf-8
+import struct
+import typing as t
+import xml.etree.ElementTree as ET
+
+XMP_HEADER = b"http://ns.adobe.com/xap/1.0/\x00"
+XMP_EXTENSION_HEADER = b"http://ns.adobe.com/xmp/extension/\x00"
+EXIF_HEADER = b"Exif\x00\x00"
+MAX_SEGMENT_LENGTH = 0xFFFF - 2
+
+SOI = b"\xff\xd8"
+APP0 = 0xE0
+APP1 = 0xE1
+SOS = 0xDA
+
+NS_X = "adobe:ns:meta/"
+NS_RDF = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+NS_DC = "http://purl.org/dc/elements/1.1/"
+namespaces = {
+    "x": NS_X,
+    "rdf": NS_RDF,
+    "dc": NS_DC,
+    "xmp": "http://ns.adobe.com/xap/1.0/",
+    "xmpMM": "http://ns.adobe.com/xap/1.0/mm/",
+    "photoshop": "http://ns.adobe.com/photoshop/1.0/",
+    "exif": "http://ns.adobe.com/exif/1.0/",
+    "tiff": "http://ns.adobe.com/tiff/1.0/",
+}
+for prefix, uri in namespaces.items():
+    ET.register_namespace(prefix, uri)
+
+packet_begin = '<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>'
+packet_end = '<?xpacket end="w"?>'
+
+
+class XMPError(Exception):
+    pass
+
+
+def _split_segments(data: bytes) -> t.Tuple[t.List[t.Tuple[int, bytes]], bytes]:
+    """Split JPEG data into (marker, segment) pairs up to the start of scan, and
+    the remaining image data"""
+    if not data.startswith(SOI):
+        raise XMPError("Not a JPEG")
+    segments: t.List[t.Tuple[int, bytes]] = []
+    pos = 2
+    while True:
+        if pos + 4 > len(data) or data[pos] != 0xFF:
+            raise XMPError("Invalid JPEG segment")
+        while data[pos + 1] == 0xFF:
+            # fill bytes
+            pos += 1
+        marker = data[pos + 1]
+        if marker == SOS:
+            return segments, data[pos:]
+        (length,) = struct.unpack(">H", data[pos + 2 : pos + 4])
+        segments.append((marker, data[pos : pos + 2 + length]))
+        pos += 2 + length
+
+
+def _new_packet() -> ET.Element:
+    xmpmeta = ET.Element(f"{{{NS_X}}}xmpmeta")
+    rdf = ET.SubElement(xmpmeta, f"{{{NS_RDF}}}RDF")
+    ET.SubElement(rdf, f"{{{NS_RDF}}}Description", {f"{{{NS_RDF}}}about": ""})
+    return xmpmeta
+
+
+def _parse_packet(segment: bytes) -> ET.Element:
+    packet = segment[4 + len(XMP_HEADER) :]
+    try:
+        xmpmeta = ET.fromstring(packet)
+    except ET.ParseError as exc:
+        raise XMPError("Unable to parse XMP packet") from exc
+    if (
+        xmpmeta.tag != f"{{{NS_X}}}xmpmeta"
+        or xmpmeta.find("rdf:RDF", namespaces) is None
+    ):
+        raise XMPError("Unexpected XMP structure")
+    return xmpmeta
+
+
+def _merge_subjects(xmpmeta: ET.Element, tags: t.List[str]) -> None:
+    rdf = xmpmeta.find("rdf:RDF", namespaces)
+    if rdf is None:
+        raise XMPError("Unexpected XMP structure")
+    descriptions = rdf.findall("rdf:Description", namespaces)
+    if not descriptions:
+        descriptions = [
+            ET.SubElement(rdf, f"{{{NS_RDF}}}Description", {f"{{{NS_RDF}}}about": ""})
+        ]
+    for description in descriptions:
+        subject = description.find("dc:subject", namespaces)
+        if subject is not None:
+            break
+    else:
+        subject = ET.SubElement(descriptions[0], f"{{{NS_DC}}}subject")
+    bag = subject.find("rdf:Bag", namespaces)
+    if bag is None:
+        if len(subject):
+            raise XMPError("dc:subject is not a bag")
+        bag = ET.SubElement(subject, f"{{{NS_RDF}}}Bag")
+    existing = [li.text for li in bag.findall("rdf:li", namespaces)]
+    for tag in tags:
+        if tag not in existing:
+            li = ET.SubElement(bag, f"{{{NS_RDF}}}li")
+            li.text = tag
+            existing.append(tag)
+
+
+def _make_segment(xmpmeta: ET.Element) -> bytes:
+    packet = packet_begin + ET.tostring(xmpmeta, encoding="unicode") + packet_end
+    payload = XMP_HEADER + packet.encode()
+    if len(payload) > MAX_SEGMENT_LENGTH:
+        raise XMPError("XMP packet too large for a single segment")
+    return bytes([0xFF, APP1]) + struct.pack(">H", len(payload) + 2) + payload
+
+
+def add_subjects(data: bytes, tags: t.List[str]) -> bytes:
+    """Insert tags into dc:subject of the XMP packet of JPEG data, merging with
+    any subjects already present.
+
+    Raises:
+        XMPError: data is not a JPEG this writer can handle
+    """
+    segments, image_data = _split_segments(data)
+    xmp_segments = [
+        segment
+        for marker, segment in segments
+        if marker == APP1 and segment[4:].startswith(XMP_HEADER)
+    ]
+    if any(
+        marker == APP1 and segment[4:].startswith(XMP_EXTENSION_HEADER)
+        for marker, segment in segments
+    ):
+        raise XMPError("Extended XMP not supported")
+    if len(xmp_segments) > 1:
+        raise XMPError("Multiple XMP packets")
+
+    xmpmeta = _parse_packet(xmp_segments[0]) if xmp_segments else _new_packet()
+    _merge_subjects(xmpmeta, tags)
+    xmp_segment = _make_segment(xmpmeta)
+
+    if xmp_segments:
+        new_segments = [
+            xmp_segment if segment is xmp_segments[0] else segment
+            for _, segment in segments
+        ]
+    else:
+        # Place after JFIF/EXIF headers, which readers expect first
+        insert_at = 0
+        for i, (marker, segment) in enumerate(segments):
+            if marker == APP0 or (
+                marker == APP1 and segment[4:].startswith(EXIF_HEADER)
+            ):
+                insert_at = i + 1
+            else:
+                break
+        new_segments = [segment for _, segment in segments]
+        new_segments.insert(insert_at, xmp_segment)
+    return SOI + b"".join(new_segments) + image_data
@@ -1,9 +1,11 @@
 #! /usr/bin/env python3
 # coding: utf-8
 import datetime as dt
+import json
 import os
 import shutil
 import typing as t
+from hashlib import sha256
 from pathlib import Path
 from types import SimpleNamespace
 
@@ -12,6 +14,7 @@ import dropbox
 
 class MockDropbox:
     metadatas: t.Dict[str, t.Optional[dropbox.files.PhotoMetadata]] = {}
+    metadata_cache: t.Optional[dropbox.files.PhotoMetadata] = None
 
     def __init__(
         self,
@@ -29,21 +32,50 @@ class MockDropbox:
 
     def files_list_folder(self, path: str, recursive: t.Optional[bool] = False):
         path_obj = Path(path)
+        if not path_obj.is_dir():
+            raise dropbox.exceptions.ApiError(
+                "request_id", "error", "user_message_text", "user_message_locale"
+            )
         files = path_obj.rglob("*") if recursive else path_obj.iterdir()
         mock_entries = [
-            dropbox.files.FileMetadata(
+            dropbox.files.FolderMetadata(
+                name=file.name,
+                id=file.as_posix(),
+                path_display=file.as_posix(),
+                path_lower=file.as_posix().lower(),
+            )
+            if file.is_dir()
+            else dropbox.files.FileMetadata(
                 name=file.name,
                 path_display=file.as_posix(),
                 path_lower=file.as_posix().lower(),
                 client_modified=dt.datetime(2000, 1, 1),
+                content_hash=sha256(file.read_bytes()).hexdigest(),
             )
             for file in files
         ]
         mock_result = SimpleNamespace(entries=mock_entries, has_more=False)
         return mock_result
 
-    def files_list_folder_continue(self, cursor) -> None:
-        pass
+    def files_list_folder_get_latest_cursor(self, path: str):
+        seen = sorted(file.as_posix() for file in Path(path).iterdir())
+        return SimpleNamespace(cursor=json.dumps({"path": path, "seen": seen}))
+
+    def files_list_folder_continue(self, cursor: str):
+        if cursor == "reset":
+            raise dropbox.exceptions.ApiError(
+                "request_id",
+                dropbox.files.ListFolderContinueError.reset,
+                "user_message_text",
+                "user_message_locale",
+            )
+        state = json.loads(cursor)
+        result = self.files_list_folder(state["path"])
+        result.entries = [
+            entry for entry in result.entries if entry.path_display not in state["seen"]
+        ]
+        result.cursor = self.files_list_folder_get_latest_cursor(state["path"]).cursor
+        return result
 
     def files_download(self, path: Path):
         with open(path, "rb") as file:
@@ -52,12 +84,24 @@ class MockDropbox:
         response = SimpleNamespace(raw=SimpleNamespace(data=data))
         return filemetadata, response
 
-    def files_upload(self, f: bytes, path: str, autorename: t.Optional[bool] = False):
+    def files_upload(
+        self,
+        f: bytes,
+        path: str,
+        autorename: t.Optional[bool] = False,
+        mode: t.Optional[dropbox.files.WriteMode] = None,
+    ):
         if not Path(path).parent.exists():
             raise dropbox.exceptions.BadInputError(request_id=1, message="message")
         with open(path, "wb") as file:
             file.write(f)
         self.metadatas[path] = self.metadata_cache
+        return dropbox.files.FileMetadata(
+            name=Path(path).name,
+            path_display=path,
+            path_lower=path.lower(),
+            content_hash=sha256(f).hexdigest(),
+        )
 
     def files_move(
         self, from_path: str, to_path: str, autorename: t.Optional[bool] = False
@@ -75,9 +119,64 @@ class MockDropbox:
         shutil.copy(from_path, to_path)
         self.metadatas[to_path] = self.metadatas[from_path]
 
+    def _relocate_batch(self, relocate_func: t.Callable, entries) -> t.Any:
+        result_entries = []
+        for entry in entries:
+            try:
+                relocate_func(from_path=entry.from_path, to_path=entry.to_path)
+            except dropbox.exceptions.BadInputError:
+                result_entries.append(
+                    dropbox.files.RelocationBatchResultEntry.failure(
+                        dropbox.files.RelocationBatchErrorEntry.internal_error
+                    )
+                )
+            else:
+                result_entries.append(
+                    dropbox.files.RelocationBatchResultEntry.success(
+                        self.files_get_metadata(entry.to_path)
+                    )
+                )
+        self.batch_job = dropbox.files.RelocationBatchV2JobStatus.complete(
+            dropbox.files.RelocationBatchV2Result(entries=result_entries)
+        )
+        return dropbox.files.RelocationBatchV2Launch.async_job_id("job_id")
+
+    def files_move_batch_v2(self, entries, autorename: t.Optional[bool] = False):
+        return self._relocate_batch(self.files_move, entries)
+
+    def files_copy_batch_v2(self, entries, autorename: t.Optional[bool] = False):
+        return self._relocate_batch(self.files_copy, entries)
+
+    def files_move_batch_check_v2(self, async_job_id: str):
+        return self.batch_job
+
+    def files_copy_batch_check_v2(self, async_job_id: str):
+        return self.batch_job
+
     def files_create_folder(self, path, autorename=False) -> None:
         os.makedirs(path)
 
+    def files_create_folder_batch(self, paths, autorename=False):
+        self.created_folders = paths
+        result_entries = []
+        for path in paths:
+            os.makedirs(path, exist_ok=True)
+            result_entries.append(
+                dropbox.files.CreateFolderBatchResultEntry.success(
+                    dropbox.files.CreateFolderEntryResult(
+                        metadata=dropbox.files.FolderMetadata(
+                            name=Path(path).name,
+                            id=path,
+                            path_display=path,
+                            path_lower=path.lower(),
+                        )
+                    )
+                )
+            )
+        return dropbox.files.CreateFolderBatchLaunch.complete(
+            dropbox.files.CreateFolderBatchResult(entries=result_entries)
+        )
+
     def files_get_metadata(self, path: str, include_media_info=False):
         try:
             metadata = self.metadatas[path]
@@ -1,5 +1,11 @@
 #! /usr/bin/env python3
 # coding: utf-8
+import shutil
+import typing as t
+from pathlib import Path
+from types import SimpleNamespace
+
+import dropbox
 import numpy as np
 import pytest
 
@@ -36,6 +42,12 @@ def test_settings_folder_names(settings):
     }
 
 
+def test_settings_face_detection(settings):
+    assert settings.face_detection == config.FaceDetection(
+        size=800, upsample=1, num_jitters=1, model="hog"
+    )
+
+
 def test_settings_locations(settings):
     assert len(settings.locations) == 1
     location = settings.locations[0]
@@ -61,8 +73,130 @@ def test_settings_recognition(settings):
     assert isinstance(settings.recognition_data["Obama"][1], np.ndarray)
 
 
+def test_settings_known_faces(settings):
+    known_faces = settings.known_faces
+    assert known_faces.names == ["Biden", "Obama"]
+    assert known_faces.encodings.dtype == np.float32
+    assert known_faces.encodings.shape == (3, 128)
+    assert known_faces.labels.tolist() == [0, 1, 1]
+    assert known_faces.group_starts.tolist() == [0, 1]
+
+
+class CountingDropbox(MockDropbox):
+    def __init__(self) -> None:
+        self.downloads: t.List[str] = []
+
+    def files_download(self, path):
+        self.downloads.append(Path(path).name)
+        return super().files_download(path)
+
+
+def test_settings_refresh(tmpdir, monkeypatch):
+    config_path = Path(tmpdir) / "config"
+    shutil.copytree(config.config_path, config_path)
+    monkeypatch.setattr("kamera.config.config_path", config_path)
+    monkeypatch.setattr("kamera.config.gallery_file", config_path / "gallery.npz")
+    dbx = CountingDropbox()
+    settings = config.Settings(dbx)
+    assert settings.known_faces.names == ["Biden", "Obama"]
+
+    assert (config_path / "gallery.npz").exists()
+    dbx.downloads = []
+    assert not settings.refresh(dbx)
+    assert dbx.downloads == []
+
+    settings_file = config_path / "settings.yaml"
+    settings_file.write_text(
+        settings_file.read_text().replace("US/Eastern", "Europe/Paris")
+    )
+    (config_path / "people" / "Carter").mkdir()
+    shutil.copy(
+        config_path / "people" / "Obama" / "obama.json",
+        config_path / "people" / "Carter" / "carter.json",
+    )
+    assert settings.refresh(dbx)
+    assert sorted(dbx.downloads) == ["carter.json", "settings.yaml"]
+    assert settings.default_tz == "Europe/Paris"
+    assert settings.known_faces.names == ["Biden", "Carter", "Obama"]
+    assert len(settings.locations) == 1
+
+    dbx.downloads = []
+    shutil.rmtree(config_path / "people" / "Carter")
+    assert settings.refresh(dbx)
+    assert dbx.downloads == []
+    assert settings.known_faces.names == ["Biden", "Obama"]
+
+
+def test_settings_gallery(tmpdir, monkeypatch):
+    config_path = Path(tmpdir) / "config"
+    shutil.copytree(config.config_path, config_path)
+    monkeypatch.setattr("kamera.config.config_path", config_path)
+    monkeypatch.setattr("kamera.config.gallery_file", config_path / "gallery.npz")
+    settings = config.Settings(MockDropbox())
+
+    dbx = CountingDropbox()
+    cached_settings = config.Settings(dbx)
+    assert sorted(dbx.downloads) == ["gallery.npz", "places.yaml", "settings.yaml"]
+    assert cached_settings.known_faces.names == settings.known_faces.names
+    np.testing.assert_array_equal(
+        cached_settings.known_faces.encodings, settings.known_faces.encodings
+    )
+
+    # per-image json files are still read, and replace the image they encode
+    (config_path / "people" / "Biden" / "biden.jpg").rename(
+        config_path / "people" / "Biden" / "obama.jpg"
+    )
+    shutil.copy(
+        config_path / "people" / "Obama" / "obama.json",
+        config_path / "people" / "Biden" / "obama.json",
+    )
+    dbx.downloads = []
+    assert cached_settings.refresh(dbx)
+    assert dbx.downloads == ["obama.json"]
+    assert len(cached_settings.recognition_data["Biden"]) == 1
+
+
+def test_settings_gallery_not_saved(tmpdir, monkeypatch):
+    monkeypatch.setattr("kamera.config.gallery_file", Path(tmpdir) / "gallery.npz")
+    dbx = MockDropbox()
+
+    def files_upload_mock(*args, **kwargs):
+        raise dropbox.exceptions.BadInputError(request_id=1, message="message")
+
+    monkeypatch.setattr(dbx, "files_upload", files_upload_mock)
+    settings = config.Settings(dbx)
+    assert settings.known_faces.names == ["Biden", "Obama"]
+    assert not (Path(tmpdir) / "gallery.npz").exists()
+
+
+class PagedDropbox(MockDropbox):
+    def files_list_folder(self, path, recursive=False):
+        result = super().files_list_folder(path, recursive)
+        entries = sorted(result.entries, key=lambda entry: entry.path_lower)
+        self.pages = [entries[i : i + 2] for i in range(0, len(entries), 2)]
+        return self.files_list_folder_continue(cursor=0)
+
+    def files_list_folder_continue(self, cursor):
+        return SimpleNamespace(
+            entries=self.pages[cursor],
+            has_more=cursor + 1 < len(self.pages),
+            cursor=cursor + 1,
+        )
+
+
+def test_settings_paginated_listing(tmpdir, monkeypatch):
+    # written outside the test data
+    monkeypatch.setattr("kamera.config.gallery_file", Path(tmpdir) / "gallery.npz")
+    settings = config.Settings(PagedDropbox())
+    assert settings.default_tz == "US/Eastern"
+    assert len(settings.locations) == 1
+    assert settings.known_faces.names == ["Biden", "Obama"]
+    assert len(settings.recognition_data["Obama"]) == 2
+
+
 @pytest.fixture()
-def settings():
+def settings(tmpdir, monkeypatch):
+    monkeypatch.setattr("kamera.config.gallery_file", Path(tmpdir) / "gallery.npz")
     dbx = MockDropbox()
     loaded_settings = config.Settings(dbx)
     return loaded_settings
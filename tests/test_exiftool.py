@@ -0,0 +1,99 @@
+#! /usr/bin/env python3
+# coding: utf-8
+import sys
+from pathlib import Path
+
+import pytest
+
+from kamera.exiftool import ExifTool, ExifToolError
+
+# Speaks exiftool's -stay_open protocol: arguments one per line, each command
+# ended by -executeN and answered with {readyN}. "Tags" an image by appending
+# the added subjects to it, and exits without answering if a crash file exists.
+fake_exiftool = f"""#! {sys.executable}
+import sys
+from pathlib import Path
+
+crash_file = Path(__file__).with_name("crash")
+args = []
+while True:
+    line = sys.stdin.readline()
+    if not line:
+        break
+    arg = line.rstrip("\\n")
+    if args == ["-stay_open"] and arg == "False":
+        break
+    if not arg.startswith("-execute"):
+        args.append(arg)
+        continue
+    if crash_file.exists():
+        crash_file.unlink()
+        sys.exit(1)
+    if "-o" in args:
+        i = args.index("-o")
+        out_file, in_file = Path(args[i + 1]), Path(args[i + 2])
+        tags = [arg.split("+=", 1)[1] for arg in args if "+=" in arg]
+        out_file.write_bytes(in_file.read_bytes() + ",".join(tags).encode())
+    print(" ".join(args))
+    print("{{ready" + arg[len("-execute") :] + "}}", flush=True)
+    args = []
+"""
+
+
+@pytest.fixture()
+def exiftool(tmpdir):
+    executable = Path(tmpdir) / "exiftool"
+    executable.write_text(fake_exiftool)
+    executable.chmod(0o755)
+    tool = ExifTool(executable.as_posix())
+    yield tool
+    tool.close()
+
+
+def test_execute_batch(exiftool) -> None:
+    output = exiftool.execute_batch([["-ver"], ["-a", "-b"]])
+    assert output.split(b"\n") == [b"-ver", b"{ready1}", b"-a -b", b"{ready2}", b""]
+    output = exiftool.execute_batch([["-c"]])
+    assert output == b"-c\n{ready3}\n"
+
+
+def test_tag_batch(exiftool) -> None:
+    outputs = exiftool.tag_batch(
+        [(b"first:", ["Paris"]), (b"second:", ["Oslo", "Rome"])]
+    )
+    assert outputs == [b"first:Paris", b"second:Oslo,Rome"]
+    assert exiftool.tag(b"third:", ["Paris"]) == b"third:Paris"
+
+
+def test_restart_after_kill(exiftool) -> None:
+    assert exiftool.tag(b"first:", ["Paris"]) == b"first:Paris"
+    pid = exiftool.process.pid
+    exiftool.process.kill()
+    exiftool.process.wait()
+    assert not exiftool.running
+    assert exiftool.tag(b"second:", ["Oslo"]) == b"second:Oslo"
+    assert exiftool.process.pid != pid
+
+
+def test_crash_during_batch(exiftool, tmpdir) -> None:
+    exiftool.start()
+    pid = exiftool.process.pid
+    (Path(tmpdir) / "crash").touch()
+    with pytest.raises(ExifToolError):
+        exiftool.execute_batch([["-ver"]])
+    assert not exiftool.running
+
+    # retried once on a new process
+    (Path(tmpdir) / "crash").touch()
+    outputs = exiftool.tag_batch([(b"first:", ["Paris"]), (b"second:", ["Oslo"])])
+    assert outputs == [b"first:Paris", b"second:Oslo"]
+    assert exiftool.process.pid != pid
+
+
+def test_close(exiftool) -> None:
+    exiftool.start()
+    process = exiftool.process
+    exiftool.close()
+    assert process.returncode == 0
+    assert exiftool.process is None
+    exiftool.close()
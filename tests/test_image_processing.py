@@ -15,7 +15,7 @@ import pytz
 from numpy import array as np_array
 from PIL import Image
 
-from kamera import config, image_processing
+from kamera import config, image_processing, recognition
 
 test_images_path = Path.cwd() / "tests" / "test_images"
 
@@ -71,7 +71,7 @@ def run_image_processing_main(
     if date is None:
         date = dt.datetime(2000, 1, 1)
 
-    output_data = image_processing.main(
+    processed = image_processing.main(
         data=input_data,
         filepath=test_images_path / "input" / filename,
         settings=settings,
@@ -79,6 +79,7 @@ def run_image_processing_main(
         coordinates=coordinates,
         date=date,
     )
+    output_data = processed.data
     if output_data is None:
         raise Exception("No output from image_processing")
     return output_data
@@ -190,6 +191,31 @@ def test_orientation(settings) -> None:
     assert_image_attrs_identical(output, desired_output)
 
 
+def test_geo_tag_equidistant_areas() -> None:
+    areas = [
+        config.Area(name="West", lat=10.0, lng=10.0, spots=[]),
+        config.Area(name="East", lat=10.0, lng=10.2, spots=[]),
+    ]
+    tag = image_processing.get_geo_tag(
+        lat=10.0, lng=10.1, location_index=config.PlaceIndex(areas)
+    )
+    assert tag in {"West", "East"}
+
+
+def test_geo_tag_no_locations() -> None:
+    tag = image_processing.get_geo_tag(
+        lat=48.8566, lng=2.3522, location_index=config.PlaceIndex([])
+    )
+    assert tag is None
+
+
+def test_recognition_downscaled_detection(settings) -> None:
+    settings.face_detection = config.FaceDetection(size=400)
+    with open(test_images_path / "input" / "recognition.jpg", "rb") as file:
+        img = Image.open(BytesIO(file.read()))
+    assert recognition.recognize_face(img, settings) == ["Obama"]
+
+
 @pytest.fixture()
 def settings():
     class MockSettings:
@@ -212,6 +238,7 @@ def settings():
                     ],
                 )
             ]
+            self.location_index = config.PlaceIndex(self.locations)
             with open(test_images_path / "encodings" / "biden.json") as j:
                 biden = json.load(j)
             with open(test_images_path / "encodings" / "obama1.json") as j:
@@ -222,5 +249,7 @@ def settings():
                 "Biden": [np_array(biden)],
                 "Obama": [np_array(obama1), np_array(obama2)],
             }
+            self.known_faces = config.KnownFaces(self.recognition_data)
+            self.face_detection = config.FaceDetection()
 
     return MockSettings()
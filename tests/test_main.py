@@ -0,0 +1,89 @@
+#! /usr/bin/env python3
+# coding: utf-8
+import typing as t
+from pathlib import Path
+
+import dropbox
+import fakeredis
+import pytest
+
+from kamera.__main__ import checkpoint_key, run_once
+from tests.test_task import MockSettings, make_pipeline_uploads
+
+
+def patch_run_once(monkeypatch, root_dir: Path, names: t.List[str]):
+    dbx = make_pipeline_uploads(monkeypatch, root_dir, names)
+    redis_client = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr("kamera.__main__.server.redis_client", redis_client)
+    monkeypatch.setattr("kamera.__main__.RetryingDropbox", lambda *args, **kwargs: dbx)
+    monkeypatch.setattr("kamera.__main__.config.get_dbx_token", lambda *args: "token")
+    monkeypatch.setattr("kamera.__main__.config.Settings", MockSettings)
+    monkeypatch.setattr("kamera.__main__.config.uploads_path", root_dir / "Uploads")
+    monkeypatch.setattr("kamera.__main__.config.review_path", root_dir / "Review")
+    monkeypatch.setattr("kamera.__main__.config.backup_path", root_dir / "Backup")
+    monkeypatch.setattr("kamera.__main__.config.errors_path", root_dir / "Error")
+    return dbx, redis_client
+
+
+def test_run_once(tmpdir, monkeypatch, caplog) -> None:
+    root_dir = Path(tmpdir)
+    names = ["a.jpg", "b.jpg", "broken.jpg", "c.mp4"]
+    dbx, redis_client = patch_run_once(monkeypatch, root_dir, names)
+    monkeypatch.setattr("kamera.__main__.config.checkpoint_interval", 2)
+    files_move = dbx.files_move
+
+    def files_move_mock(from_path: str, to_path: str, **kwargs) -> None:
+        if from_path.endswith("b.jpg"):
+            raise dropbox.exceptions.BadInputError(request_id=1, message="message")
+        files_move(from_path, to_path, **kwargs)
+
+    monkeypatch.setattr(dbx, "files_move", files_move_mock)
+
+    run_once("account", jobs=2)
+    uploads = sorted(file.name for file in (root_dir / "Uploads").iterdir())
+    assert uploads == ["b.jpg"]
+    assert [file.name for file in (root_dir / "Error").iterdir()] == ["broken.jpg"]
+    review = [file for file in (root_dir / "Review").rglob("*") if file.is_file()]
+    assert len(review) == 3
+    assert not redis_client.exists(checkpoint_key("account"))
+    assert "Processed 4 entries" in caplog.text
+    assert "Results: done: 3, error: 1" in caplog.text
+
+    # not moved, so processed again
+    caplog.clear()
+    monkeypatch.setattr(dbx, "files_move", files_move)
+    run_once("account", jobs=2)
+    assert "Processed 1 entries" in caplog.text
+    assert list((root_dir / "Uploads").iterdir()) == []
+
+
+def test_run_once_resume(tmpdir, monkeypatch, caplog) -> None:
+    root_dir = Path(tmpdir)
+    names = ["a.jpg", "b.jpg", "broken.jpg", "c.mp4"]
+    dbx, redis_client = patch_run_once(monkeypatch, root_dir, names)
+    monkeypatch.setattr("kamera.__main__.config.checkpoint_interval", 100)
+    files_copy_batch_v2 = dbx.files_copy_batch_v2
+
+    def files_copy_batch_v2_mock(*args, **kwargs):
+        # copied c.mp4, but interrupted before moving anything
+        files_copy_batch_v2(*args, **kwargs)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(dbx, "files_copy_batch_v2", files_copy_batch_v2_mock)
+    with pytest.raises(KeyboardInterrupt):
+        run_once("account", jobs=2)
+    uploads = sorted(file.name for file in (root_dir / "Uploads").iterdir())
+    assert uploads == names
+    assert redis_client.hlen(checkpoint_key("account")) == 4
+
+    caplog.clear()
+    monkeypatch.setattr(dbx, "files_copy_batch_v2", files_copy_batch_v2)
+    run_once("account", jobs=2)
+    assert "Resumed transfers from previous runs: 4" in caplog.text
+    assert "Processed 0 entries" in caplog.text
+    assert list((root_dir / "Uploads").iterdir()) == []
+    assert [file.name for file in (root_dir / "Error").iterdir()] == ["broken.jpg"]
+    review = [file for file in (root_dir / "Review").rglob("*") if file.is_file()]
+    # c.mp4 not copied twice
+    assert len(review) == 3
+    assert not redis_client.exists(checkpoint_key("account"))
@@ -5,7 +5,7 @@ import typing as t
 import numpy as np
 
 from kamera import recognition
-from kamera.config import facial_encoding
+from kamera.config import KnownFaces, facial_encoding
 from kamera.recognition import Match
 
 
@@ -31,9 +31,9 @@ def test_get_closest_match(monkeypatch) -> None:
     }
     unknown_encoding: facial_encoding = encoding(9)
     tolerance = 3
-    matches = recognition._match_face_with_known_people(
-        known_people=known_people,
-        unknown_encoding=unknown_encoding,
+    (matches,) = recognition._get_matches_for_encodings(
+        known_faces=KnownFaces(known_people),
+        unknown_encodings=[unknown_encoding],
         tolerance=tolerance,
     )
     assert sorted(matches) == [
@@ -41,3 +41,22 @@ def test_get_closest_match(monkeypatch) -> None:
         Match(distance=1.0, name="p2"),
         Match(distance=2.0, name="p1"),
     ]
+
+
+def test_get_matches_for_multiple_faces() -> None:
+    known_people: t.Dict[str, t.List[facial_encoding]] = {
+        "p1": [encoding(1)],
+        "p2": [encoding(2), encoding(20)],
+        "p3": [encoding(30)],
+    }
+    unknown_encodings = [encoding(1), encoding(19), encoding(100)]
+    tolerance = 2
+    match_lists = recognition._get_matches_for_encodings(
+        known_faces=KnownFaces(known_people),
+        unknown_encodings=unknown_encodings,
+        tolerance=tolerance,
+    )
+    assert [sorted(match_list) for match_list in match_lists] == [
+        [Match(distance=0.0, name="p1"), Match(distance=1.0, name="p2")],
+        [Match(distance=1.0, name="p2")],
+    ]
@@ -0,0 +1,147 @@
+#! /usr/bin/env python3
+# coding: utf-8
+import typing as t
+from unittest.mock import Mock
+
+import dropbox
+import fakeredis
+import pytest
+import requests
+
+from kamera.retry import RetryingDropbox, RetryPolicy, TokenBucket
+
+
+class FlakyCall:
+    def __init__(self, errors: t.List[Exception]) -> None:
+        self.errors = errors
+        self.calls = 0
+
+    def __call__(self, arg: str) -> str:
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return arg
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+        self.sleeps: t.List[float] = []
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture()
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr("kamera.retry.time.time", clock.time)
+    monkeypatch.setattr("kamera.retry.time.sleep", clock.sleep)
+    return clock
+
+
+def test_retry_respects_retry_after(clock) -> None:
+    func = FlakyCall(
+        [
+            dropbox.exceptions.RateLimitError("request_id", backoff=7),
+            dropbox.exceptions.InternalServerError("request_id", 503, None),
+            requests.exceptions.ConnectionError(),
+        ]
+    )
+    policy = RetryPolicy(max_attempts=4, base_delay=1, max_delay=60)
+    assert policy.call(None, func, "result") == "result"
+    assert func.calls == 4
+    assert clock.sleeps[0] == 7
+    assert 0 <= clock.sleeps[1] <= 2
+    assert 0 <= clock.sleeps[2] <= 4
+
+
+def test_retry_gives_up(clock) -> None:
+    func = FlakyCall([requests.exceptions.SSLError() for _ in range(3)])
+    policy = RetryPolicy(max_attempts=3, base_delay=1, max_delay=60)
+    with pytest.raises(requests.exceptions.SSLError):
+        policy.call(None, func, "result")
+    assert func.calls == 3
+    assert len(clock.sleeps) == 2
+
+
+def test_retry_ignores_other_errors(clock) -> None:
+    func = FlakyCall([dropbox.exceptions.BadInputError("request_id", "message")])
+    with pytest.raises(dropbox.exceptions.BadInputError):
+        RetryPolicy().call(None, func, "result")
+    assert func.calls == 1
+    assert clock.sleeps == []
+
+
+def test_token_bucket_shared_between_workers(clock) -> None:
+    server = fakeredis.FakeServer()
+    bucket1 = TokenBucket(
+        fakeredis.FakeStrictRedis(server=server), "account", rate=1, capacity=2
+    )
+    bucket2 = TokenBucket(
+        fakeredis.FakeStrictRedis(server=server), "account", rate=1, capacity=2
+    )
+    assert bucket1.try_acquire() == 0
+    assert bucket2.try_acquire() == 0
+    assert bucket1.try_acquire() > 0
+
+    clock.sleep(1)
+    assert bucket2.try_acquire() == 0
+
+    bucket2.block(30)
+    assert bucket1.try_acquire() == 30
+
+    func = FlakyCall([dropbox.exceptions.RateLimitError("request_id", backoff=5)])
+    RetryPolicy().call(bucket1, func, "result")
+    assert clock.sleeps == [1, 30, 5]
+    assert bucket2.try_acquire() == 0
+
+
+def test_clients_share_session() -> None:
+    dbx1 = RetryingDropbox("token1")
+    dbx2 = RetryingDropbox("token2", account_id="account", redis_client=Mock())
+    assert dbx1._session is dbx2._session
+    assert dbx1._max_retries_on_rate_limit == 0
+
+
+def test_retry_non_idempotent(clock) -> None:
+    policy = RetryPolicy(max_attempts=3, base_delay=1, max_delay=60)
+    func = FlakyCall([requests.exceptions.ReadTimeout()])
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        policy.call(None, func, "result", idempotent=False)
+    assert func.calls == 1
+
+    func = FlakyCall(
+        [
+            requests.exceptions.ConnectTimeout(),
+            dropbox.exceptions.RateLimitError("request_id", backoff=1),
+        ]
+    )
+    assert policy.call(None, func, "result", idempotent=False) == "result"
+    assert func.calls == 3
+
+    func = FlakyCall([dropbox.exceptions.InternalServerError("request_id", 500, None)])
+    with pytest.raises(dropbox.exceptions.InternalServerError):
+        policy.call(None, func, "result", idempotent=False)
+    assert func.calls == 1
+
+    func = FlakyCall([dropbox.exceptions.InternalServerError("request_id", 503, None)])
+    assert policy.call(None, func, "result", idempotent=False) == "result"
+    assert func.calls == 2
+
+
+def test_client_retries_by_route(clock, monkeypatch) -> None:
+    request = Mock(side_effect=[requests.exceptions.ReadTimeout(), "result"])
+    monkeypatch.setattr(dropbox.Dropbox, "request", request)
+    dbx = RetryingDropbox("token")
+    assert dbx.files_get_metadata("/file.jpg") == "result"
+    assert request.call_count == 2
+
+    request.side_effect = [requests.exceptions.ReadTimeout(), "result"]
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        dbx.files_move_v2("/file.jpg", "/Review/file.jpg", autorename=True)
+    assert request.call_count == 3
@@ -10,11 +10,12 @@ import rq
 from PIL import Image
 
 from kamera import server
+from kamera.task import add_jobs, jobs_key, reset_uploads_cursor
 from tests.mock_dropbox import MockDropbox
 
 
 @patch("kamera.server.hmac", Mock())
-@patch("kamera.server.dropbox.Dropbox", MockDropbox)
+@patch("kamera.server.RetryingDropbox", MockDropbox)
 def test_webhook(client, tmpdir, monkeypatch) -> None:
     account_id = "test_webhook"
     temp_path = Path(tmpdir)
@@ -27,29 +28,125 @@ def test_webhook(client, tmpdir, monkeypatch) -> None:
         monkeypatch.setattr("kamera.server.config.uploads_path", temp_path)
         rv = client.post("/webhook", json={"list_folder": {"accounts": [account_id]}})
         assert rv.data == b""
+        assert server.queue.job_ids == []
+        sync_jobs = server.sync_queue.jobs
+        assert len(sync_jobs) == 1
+        assert sync_jobs[0].func == server.sync_account
+        assert sync_jobs[0].args == (account_id,)
+
+        server.sync_account(account_id)
         assert server.queue.job_ids == [f"{account_id}:{file_name}"]
+        assert server.queue.jobs[0].timeout == server.config.entry_timeout
+
+
+def test_sync_enqueued_once() -> None:
+    account_id = "test_sync_enqueued_once"
+    with patch_redis():
+        server.enqueue_sync(account_id)
+        server.enqueue_sync(account_id)
+        assert server.sync_queue.count == 1
+
+        with patch("kamera.server.enqueue_new_entries"):
+            server.sync_account(account_id)
+        server.enqueue_sync(account_id)
+        assert server.sync_queue.count == 2
+
+
+@patch("kamera.server.RetryingDropbox", MockDropbox)
+def test_incremental_listing(tmpdir, monkeypatch) -> None:
+    account_id = "test_incremental_listing"
+    temp_path = Path(tmpdir)
+    monkeypatch.setattr("kamera.server.config.uploads_path", temp_path)
+    Image.new("RGB", (1, 1)).save(temp_path / "in_file1.jpg", "PNG")
+    full_listing = Mock(wraps=server.dbx_list_entries)
+    monkeypatch.setattr("kamera.server.dbx_list_entries", full_listing)
+
+    with patch_redis() as mock_redis, patch.dict(server.dbx_cache, clear=True):
+        mock_redis.hset(f"user:{account_id}", "token", "test_token")
+        server.enqueue_new_entries(account_id)
+        assert server.queue.job_ids == [f"{account_id}:in_file1.jpg"]
+        assert full_listing.call_count == 1
+
+        Image.new("RGB", (1, 1)).save(temp_path / "in_file2.jpg", "PNG")
+        finish_jobs(account_id, mock_redis)
+        server.enqueue_new_entries(account_id)
+        assert server.queue.job_ids == [f"{account_id}:in_file2.jpg"]
+        assert full_listing.call_count == 1
+
+        finish_jobs(account_id, mock_redis)
+        server.enqueue_new_entries(account_id)
+        assert server.queue.job_ids == []
+
+        mock_redis.hset(f"user:{account_id}", "uploads_cursor", "reset")
+        server.enqueue_new_entries(account_id)
+        assert sorted(server.queue.job_ids) == [
+            f"{account_id}:in_file1.jpg",
+            f"{account_id}:in_file2.jpg",
+        ]
+        assert full_listing.call_count == 2
+
+        # entries left behind by lost jobs are found by the next full listing
+        finish_jobs(account_id, mock_redis)
+        mock_redis.hset(f"user:{account_id}", "uploads_listed_at", 0)
+        server.enqueue_new_entries(account_id)
+        assert len(server.queue.job_ids) == 2
+        assert full_listing.call_count == 3
+
+        finish_jobs(account_id, mock_redis)
+        reset_uploads_cursor(account_id, mock_redis)
+        server.enqueue_new_entries(account_id)
+        assert len(server.queue.job_ids) == 2
+        assert full_listing.call_count == 4
+
+        # uploaded again while the job of an earlier file of that name runs
+        finish_jobs(account_id, mock_redis)
+        add_jobs(account_id, [f"{account_id}:in_file3.jpg"], mock_redis)
+        Image.new("RGB", (1, 1)).save(temp_path / "in_file3.jpg", "PNG")
+        server.enqueue_new_entries(account_id)
+        assert server.queue.job_ids == []
+        finish_jobs(account_id, mock_redis)
+        server.enqueue_new_entries(account_id)
+        assert server.queue.job_ids == [f"{account_id}:in_file3.jpg"]
+        assert full_listing.call_count == 4
 
 
 @patch("kamera.server.hmac", Mock())
 def test_rate_limiter(client) -> None:
     account_id = "test_rate_limiter"
     request_data = {"list_folder": {"accounts": [account_id]}}
-    with patch("kamera.server.enqueue_new_entries") as test_called, patch_redis():
+    with patch("kamera.server.enqueue_sync") as test_called, patch_redis():
         client.post("/webhook", json=request_data)
         client.post("/webhook", json=request_data)
     assert test_called.call_count == 1
 
 
+@patch("kamera.server.RetryingDropbox", MockDropbox)
+def test_dbx_caching() -> None:
+    account_id = "test_dbx_caching"
+    with patch_redis() as mock_redis, patch.dict(server.dbx_cache, clear=True):
+        mock_redis.hset(f"user:{account_id}", "token", "token1")
+        dbx1 = server.load_dbx_from_cache(account_id)
+        assert server.load_dbx_from_cache(account_id) is dbx1
+
+        mock_redis.hset(f"user:{account_id}", "token", "token2")
+        assert server.load_dbx_from_cache(account_id) is not dbx1
+
+
+def finish_jobs(account_id: str, mock_redis: fakeredis.FakeStrictRedis) -> None:
+    server.queue.empty()
+    mock_redis.delete(jobs_key(account_id))
+
+
 @contextmanager
 def patch_redis() -> fakeredis.FakeStrictRedis:
     mock_redis = fakeredis.FakeStrictRedis()
     mock_queue = rq.Queue(connection=mock_redis)
-    mock_running_jobs_registry = rq.registry.StartedJobRegistry(connection=mock_redis)
+    mock_sync_queue = rq.Queue("sync", connection=mock_redis)
     with patch.multiple(
         "kamera.server",
         redis_client=mock_redis,
         queue=mock_queue,
-        running_jobs_registry=mock_running_jobs_registry,
+        sync_queue=mock_sync_queue,
         redis_lock=Mock(),
     ):
         yield mock_redis
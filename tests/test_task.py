@@ -2,10 +2,14 @@
 # coding: utf-8
 import datetime as dt
 import os
+import time
 import typing as t
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+from hashlib import sha256
 from io import BytesIO
 from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import Mock
 
 import dropbox
 import fakeredis
@@ -13,8 +17,21 @@ import pytest
 import pytz
 from PIL import Image
 
-from kamera import config
-from kamera.task import Task
+from kamera import config, image_processing
+from kamera.task import (
+    KnownFolders,
+    Task,
+    TaskBatch,
+    TimezoneResolver,
+    TransferBatcher,
+    add_jobs,
+    batch_size,
+    claim_hash,
+    delete_hash,
+    get_jobs,
+    hash_chunk_keys,
+    start_jobs,
+)
 from tests.mock_dropbox import MockDropbox
 
 default_client_modified = dt.datetime(2000, 1, 1, 10, 30)
@@ -50,6 +67,8 @@ def run_task_process_entry(
     root_dir: Path,
     file_name: t.Optional[str] = None,
     metadata: t.Optional[dropbox.files.PhotoMetadata] = None,
+    transfers: t.Optional[TransferBatcher] = None,
+    with_content_hash: bool = False,
 ) -> None:
     account_id = test_name
     stem = test_name if file_name is None else file_name
@@ -60,7 +79,9 @@ def run_task_process_entry(
     with open(in_file, "wb") as file:
         file.write(image)
     dbx_entry = dropbox.files.FileMetadata(
-        path_display=in_file.as_posix(), client_modified=default_client_modified
+        path_display=in_file.as_posix(),
+        client_modified=default_client_modified,
+        content_hash=sha256(image).hexdigest() if with_content_hash else None,
     )
     task = Task(
         account_id=account_id,
@@ -74,7 +95,10 @@ def run_task_process_entry(
     fake_dbx = MockDropbox(in_file=in_file, metadata=metadata)
     fake_settings = MockSettings(account_id)
     task.process_entry(
-        redis_client=fake_redis_client, dbx=fake_dbx, settings=fake_settings
+        redis_client=fake_redis_client,
+        dbx=fake_dbx,
+        settings=fake_settings,
+        transfers=transfers,
     )
 
 
@@ -322,6 +346,124 @@ def test_date_moved_to_filename_start(
     assert out_file.stem == f"{date_str_out} {prefix}"
 
 
+def test_batched_transfers(tmpdir, monkeypatch) -> None:
+    root_dir = Path(tmpdir)
+    make_all_temp_folders(root_dir)
+
+    def img_processing_mock(data, filepath, *args, **kwargs):
+        # distinct images, so neither is taken as a duplicate of the other
+        img_hash = sha256(filepath.name.encode()).hexdigest()[:16]
+        return image_processing.ProcessedImage(data=None, img_hash=img_hash)
+
+    monkeypatch.setattr("kamera.task.image_processing.main", img_processing_mock)
+    transfers = TransferBatcher(MockDropbox(), poll_interval=0)
+    for file_name in ["first", "second"]:
+        run_task_process_entry(
+            test_name="test_batched_transfers",
+            ext=".jpg",
+            root_dir=root_dir,
+            file_name=file_name,
+            transfers=transfers,
+        )
+    uploads, review, backup, error = _get_folder_contents(root_dir)
+    assert len(uploads) == 2
+    assert review == backup == []
+
+    results = transfers.flush()
+    uploads, review, backup, error = _get_folder_contents(root_dir)
+    assert error == [], "No error during processing"
+    assert uploads == []
+    assert len(review) == 4
+    assert len(backup) == 4
+    assert [result.from_path.stem for result in results] == ["first", "second"]
+    for result in results:
+        assert result.to_path is not None
+        assert root_dir / "Backup" in result.to_path.parents
+        assert result.copied_to is not None
+        assert root_dir / "Review" in result.copied_to.parents
+
+
+def test_batched_transfers_fallback(tmpdir, monkeypatch) -> None:
+    root_dir = Path(tmpdir)
+    make_all_temp_folders(root_dir)
+    dbx = MockDropbox()
+    in_files = []
+    for name in ["first.mp4", "second.mp4"]:
+        in_file = root_dir / "Uploads" / name
+        in_file.write_bytes(name.encode())
+        MockDropbox(in_file=in_file)
+        in_files.append(in_file)
+
+    def files_copy_batch_v2_mock(*args, **kwargs):
+        return SimpleNamespace(is_complete=lambda: False, is_async_job_id=lambda: False)
+
+    def files_move_batch_v2_mock(*args, **kwargs):
+        raise dropbox.exceptions.ApiError(
+            "request_id", "error", "user_message_text", "user_message_locale"
+        )
+
+    monkeypatch.setattr(dbx, "files_copy_batch_v2", files_copy_batch_v2_mock)
+    monkeypatch.setattr(dbx, "files_move_batch_v2", files_move_batch_v2_mock)
+    transfers = TransferBatcher(dbx, poll_interval=0)
+    for in_file in in_files:
+        transfers.add(
+            in_file,
+            root_dir / "Backup" / in_file.name,
+            root_dir / "Review" / in_file.name,
+            root_dir / "Error" / in_file.name,
+        )
+    # transferred one by one instead
+    results = transfers.flush()
+    uploads, review, backup, error = _get_folder_contents(root_dir)
+    assert uploads == error == []
+    assert sorted(file.name for file in review) == ["first.mp4", "second.mp4"]
+    assert sorted(file.name for file in backup) == ["first.mp4", "second.mp4"]
+    assert not any(result.error for result in results)
+
+
+def test_known_folders(tmpdir) -> None:
+    root_dir = Path(tmpdir)
+    make_all_temp_folders(root_dir)
+    (root_dir / "Backup" / "2000" / "01").mkdir(parents=True)
+    dbx = MockDropbox()
+    known_folders = KnownFolders(
+        dbx, [root_dir / "Review", root_dir / "Backup", root_dir / "Error"]
+    )
+    review_folder = root_dir / "Review" / "2000" / "01"
+    backup_folder = root_dir / "Backup" / "2000" / "01"
+    known_folders.ensure([review_folder, backup_folder])
+    assert dbx.created_folders == [review_folder.as_posix()]
+    assert review_folder.is_dir()
+
+    dbx.created_folders = None
+    known_folders.ensure([review_folder, backup_folder, root_dir / "Review" / "2000"])
+    assert dbx.created_folders is None
+
+
+def test_known_folders_not_recursive(tmpdir, monkeypatch) -> None:
+    root_dir = Path(tmpdir)
+    make_all_temp_folders(root_dir)
+    (root_dir / "Backup" / "2000" / "01" / "Event").mkdir(parents=True)
+    dbx = MockDropbox()
+    listed = []
+    files_list_folder = dbx.files_list_folder
+
+    def files_list_folder_mock(path: str, recursive: bool = False):
+        listed.append((path, recursive))
+        return files_list_folder(path, recursive)
+
+    monkeypatch.setattr(dbx, "files_list_folder", files_list_folder_mock)
+    known_folders = KnownFolders(dbx, [root_dir / "Backup"])
+    known_folders.refresh()
+    backup = (root_dir / "Backup").as_posix()
+    assert listed == [(backup, False), (f"{backup}/2000", False)]
+    assert known_folders.folders == {
+        backup.lower(),
+        f"{backup}/2000".lower(),
+        f"{backup}/2000/01".lower(),
+    }
+
+
 def test_settings_caching(tmpdir, settings, monkeypatch) -> None:
     monkeypatch.setattr("kamera.task.config.Settings", MockSettings)
     account_id = "test_settings_caching"
@@ -366,6 +508,230 @@ def test_settings_caching(tmpdir, settings, monkeypatch) -> None:
     assert id(settings1) == id(settings2)
 
 
+def test_settings_cache_bounded(monkeypatch) -> None:
+    monkeypatch.setattr("kamera.task.config.Settings", MockSettings)
+    monkeypatch.setattr("kamera.task.config.settings_cache_size", 2)
+    monkeypatch.setattr("kamera.task.Task.settings_cache", OrderedDict())
+    settings1 = Task.load_settings_from_cache("account1", MockDropbox())
+    Task.load_settings_from_cache("account2", MockDropbox())
+    assert Task.load_settings_from_cache("account1", MockDropbox()) is settings1
+    Task.load_settings_from_cache("account3", MockDropbox())
+    assert list(Task.settings_cache) == ["account1", "account3"]
+
+
+def test_job_index(tmpdir, monkeypatch) -> None:
+    redis_client = fakeredis.FakeStrictRedis()
+    add_jobs("account1", ["account1:old.jpg"], redis_client)
+    add_jobs("account2", ["account2:in_file.jpg"], redis_client)
+    assert get_jobs("account1", redis_client) == {"account1:old.jpg"}
+
+    # started, and past its deadline
+    monkeypatch.setattr("kamera.task.config.entry_timeout", -1)
+    start_jobs("account1", ["account1:old.jpg"], redis_client)
+    assert get_jobs("account1", redis_client) == set()
+    monkeypatch.undo()
+
+    monkeypatch.setattr("kamera.task.Task.redis_client", redis_client)
+    entry = dropbox.files.FileMetadata(
+        path_display=(Path(tmpdir) / "Uploads" / "in_file.jpg").as_posix(),
+        client_modified=default_client_modified,
+    )
+    task = Task("account1", entry, Path(tmpdir), Path(tmpdir), Path(tmpdir))
+    add_jobs("account1", [task.job_id], redis_client)
+    assert get_jobs("account1", redis_client) == {"account1:in_file.jpg"}
+    # no token: fails during setup, and is still removed from the index
+    task.main()
+    assert get_jobs("account1", redis_client) == set()
+    assert get_jobs("account2", redis_client) == {"account2:in_file.jpg"}
+
+
+def test_task_batch(tmpdir, monkeypatch) -> None:
+    redis_client = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr("kamera.task.Task.redis_client", redis_client)
+    monkeypatch.setattr(Task, "load_dbx_from_cache", lambda *args: MockDropbox())
+    monkeypatch.setattr(Task, "load_settings_from_cache", lambda *args: None)
+    monkeypatch.setattr(Task, "load_folders_from_cache", lambda *args: None)
+    monkeypatch.setattr("kamera.task.config.pipeline_cpu_workers", 0)
+
+    def process_entry_mock(self, *args, **kwargs) -> bool:
+        if self.name == "failed.jpg":
+            raise Exception("This is an exception from mock process_entry")
+        return self.name == "done.jpg"
+
+    monkeypatch.setattr(Task, "process_entry", process_entry_mock)
+    tasks = [
+        Task(
+            "account",
+            dropbox.files.FileMetadata(
+                path_display=(Path(tmpdir) / "Uploads" / name).as_posix(),
+                client_modified=default_client_modified,
+            ),
+            Path(tmpdir),
+            Path(tmpdir),
+            Path(tmpdir),
+        )
+        for name in ["failed.jpg", "error.jpg", "done.jpg"]
+    ]
+    batch = TaskBatch("account", tasks)
+    assert batch.job_id == "account:failed.jpg+2"
+    add_jobs("account", [task.job_id for task in tasks], redis_client)
+    redis_client.hset("user:account", "uploads_cursor", "cursor")
+    assert batch.main() == {
+        "failed.jpg": "failed",
+        "error.jpg": "error",
+        "done.jpg": "done",
+    }
+    assert get_jobs("account", redis_client) == set()
+    # the failed entry is listed again by the next sync
+    assert redis_client.hget("user:account", "uploads_cursor") is None
+
+
+def test_task_batch_transfer_error(tmpdir, monkeypatch) -> None:
+    root_dir = Path(tmpdir)
+    make_all_temp_folders(root_dir)
+    in_file = root_dir / "Uploads" / "done.jpg"
+    in_file.write_bytes(b"done")
+    dbx = MockDropbox(in_file=in_file)
+    redis_client = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr("kamera.task.Task.redis_client", redis_client)
+    monkeypatch.setattr(Task, "load_dbx_from_cache", lambda *args: dbx)
+    monkeypatch.setattr(Task, "load_settings_from_cache", lambda *args: None)
+    monkeypatch.setattr(Task, "load_folders_from_cache", lambda *args: None)
+    monkeypatch.setattr("kamera.task.config.pipeline_cpu_workers", 0)
+
+    def files_copy_mock(*args, **kwargs):
+        raise dropbox.exceptions.BadInputError(request_id=1, message="message")
+
+    def process_entry_mock(self, redis_client, dbx, settings, transfers, *args):
+        self.relocate(
+            dbx,
+            transfers,
+            root_dir / "Backup" / self.name,
+            copy_to=root_dir / "Review" / self.name,
+        )
+        return True
+
+    monkeypatch.setattr(dbx, "files_copy", files_copy_mock)
+
+    monkeypatch.setattr(Task, "process_entry", process_entry_mock)
+    entry = dropbox.files.FileMetadata(
+        path_display=in_file.as_posix(), client_modified=default_client_modified
+    )
+    task = Task(
+        "account", entry, root_dir / "Review", root_dir / "Backup", root_dir / "Error"
+    )
+    assert TaskBatch("account", [task]).main() == {"done.jpg": "error"}
+    assert [file.name for file in (root_dir / "Error").iterdir()] == ["done.jpg"]
+
+
+def make_pipeline_uploads(
+    monkeypatch, root_dir: Path, names: t.List[str]
+) -> MockDropbox:
+    """Make uploads named names, with image processing mocked to fail for
+    broken.jpg, and return the Dropbox client to process them with"""
+    make_all_temp_folders(root_dir)
+    dbx = MockDropbox()
+    monkeypatch.setattr(
+        Task,
+        "load_folders_from_cache",
+        lambda *args: KnownFolders(dbx, [root_dir / "Review", root_dir / "Backup"]),
+    )
+
+    def img_processing_mock(data, *args, **kwargs):
+        if data == b"broken":
+            raise Exception("This is an exception from mock image_processing")
+        img_hash = sha256(data).hexdigest()[:16]
+        return image_processing.ProcessedImage(data=None, img_hash=img_hash)
+
+    # the pipeline's processes are forked after this, and so run the mock
+    monkeypatch.setattr("kamera.task.image_processing.main", img_processing_mock)
+    for name in names:
+        in_file = root_dir / "Uploads" / name
+        in_file.write_bytes(b"broken" if name == "broken.jpg" else name.encode())
+        MockDropbox(in_file=in_file)
+    return dbx
+
+
+def test_task_batch_pipeline(tmpdir, monkeypatch) -> None:
+    root_dir = Path(tmpdir)
+    names = ["a.jpg", "b.jpg", "broken.jpg", "c.mp4", "d.jpg"]
+    dbx = make_pipeline_uploads(monkeypatch, root_dir, names)
+    redis_client = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr("kamera.task.Task.redis_client", redis_client)
+    monkeypatch.setattr("kamera.task.config.pipeline_cpu_workers", 2)
+    monkeypatch.setattr("kamera.task.config.pipeline_window", 2)
+    monkeypatch.setattr(Task, "load_dbx_from_cache", lambda *args: dbx)
+    monkeypatch.setattr(
+        Task, "load_settings_from_cache", lambda *args: MockSettings("account")
+    )
+    tasks = [
+        Task(
+            "account",
+            dropbox.files.FileMetadata(
+                path_display=(root_dir / "Uploads" / name).as_posix(),
+                client_modified=default_client_modified,
+            ),
+            root_dir / "Review",
+            root_dir / "Backup",
+            root_dir / "Error",
+        )
+        for name in names
+    ]
+    assert TaskBatch("account", tasks).main() == {
+        "a.jpg": "done",
+        "b.jpg": "done",
+        "broken.jpg": "error",
+        "c.mp4": "done",
+        "d.jpg": "done",
+    }
+    uploads, review, backup, error = _get_folder_contents(root_dir)
+    assert uploads == []
+    assert sorted(file.name for file in review if file.is_file()) == [
+        "2000-01-01 05.30.00 a.jpg",
+        "2000-01-01 05.30.00 b.jpg",
+        "2000-01-01 05.30.00 c.mp4",
+        "2000-01-01 05.30.00 d.jpg",
+    ]
+    assert len([file for file in backup if file.is_file()]) == 4
+    assert [file.name for file in error] == ["broken.jpg"]
+
+
+def test_batch_size(monkeypatch) -> None:
+    monkeypatch.setattr("kamera.task.config.batch_target_jobs", 8)
+    monkeypatch.setattr("kamera.task.config.batch_max_size", 50)
+    assert batch_size(0) == 1
+    assert batch_size(8) == 1
+    assert batch_size(9) == 2
+    assert batch_size(100) == 13
+    assert batch_size(10000) == 50
+
+
+def test_batch_cpu_workers(monkeypatch) -> None:
+    monkeypatch.setattr("kamera.task.config.pipeline_cpu_workers", 8)
+    tasks = t.cast(t.List[Task], [Mock() for _ in range(3)])
+    assert TaskBatch("account", tasks).cpu_workers() == 3
+    assert TaskBatch("account", tasks * 4).cpu_workers() == 8
+    monkeypatch.setattr(TaskBatch, "worker_processes", 4)
+    assert TaskBatch("account", tasks * 4).cpu_workers() == 2
+    monkeypatch.setattr(TaskBatch, "worker_processes", 16)
+    assert TaskBatch("account", tasks).cpu_workers() == 1
+
+
+def test_timezone_resolver_caching(monkeypatch) -> None:
+    resolver = TimezoneResolver(precision=3, cache_size=10)
+    calls = []
+
+    def timezone_at_mock(lat, lng):
+        calls.append((lat, lng))
+        return "Europe/Paris"
+
+    monkeypatch.setattr(resolver.finder, "timezone_at", timezone_at_mock)
+    assert resolver.timezone_at(lat=48.866_269_4, lng=2.324_258_3) == "Europe/Paris"
+    assert resolver.timezone_at(lat=48.866_301_2, lng=2.324_199_9) == "Europe/Paris"
+    assert resolver.timezone_at(lat=48.8566, lng=2.3522) == "Europe/Paris"
+    assert calls == [(48.866, 2.324), (48.857, 2.352)]
+
+
 @pytest.mark.parametrize("extension", config.image_extensions)
 @pytest.mark.parametrize("process_img", [True, False])
 def test_duplicate_worse(tmpdir, extension, monkeypatch, process_img) -> None:
@@ -403,6 +769,74 @@ def test_duplicate_worse(tmpdir, extension, monkeypatch, process_img) -> None:
     assert len(list((root_dir / "Backup").rglob("*better*"))) == 1
 
 
+@pytest.mark.parametrize("process_img", [True, False])
+def test_identical_reupload(tmpdir, monkeypatch, process_img) -> None:
+    root_dir = Path(tmpdir)
+    make_all_temp_folders(root_dir)
+    monkeypatch_img_processing(monkeypatch, return_new_data=process_img)
+    test_name = f"test_identical_reupload{process_img}"
+    run_task_process_entry(
+        test_name, ".jpg", root_dir, file_name="first", with_content_hash=True
+    )
+
+    def files_download_mock(*args, **kwargs):
+        raise Exception("Identical image downloaded")
+
+    with monkeypatch.context() as m:
+        m.setattr(MockDropbox, "files_download", files_download_mock)
+        run_task_process_entry(
+            test_name, ".jpg", root_dir, file_name="second", with_content_hash=True
+        )
+    uploads, review, backup, error = _get_folder_contents(root_dir)
+    assert error == [], "No error during processing"
+    assert uploads == []
+    assert [file.name for file in review if file.is_file()] == [
+        "2000-01-01 05.30.00 first.jpg"
+    ]
+    assert len([file for file in backup if file.is_file()]) == 2
+
+    # processed again once the earlier image is gone
+    for file in review:
+        if file.is_file():
+            file.unlink()
+            del MockDropbox.metadatas[file.as_posix()]
+    run_task_process_entry(
+        test_name, ".jpg", root_dir, file_name="third", with_content_hash=True
+    )
+    uploads, review, backup, error = _get_folder_contents(root_dir)
+    assert error == [], "No error during processing"
+    assert [file.name for file in review if file.is_file()] == [
+        "2000-01-01 05.30.00 third.jpg"
+    ]
+
+
+@pytest.mark.parametrize("process_img", [True, False])
+def test_duplicate_worse_batched(tmpdir, monkeypatch, process_img) -> None:
+    root_dir = Path(tmpdir)
+    make_all_temp_folders(root_dir)
+    monkeypatch_img_processing(monkeypatch, return_new_data=process_img)
+    transfers = TransferBatcher(MockDropbox())
+    for file_name, size in [("worse", 100), ("better", 150)]:
+        run_task_process_entry(
+            test_name=f"test_duplicate_worse_batched{process_img}",
+            ext=".jpg",
+            root_dir=root_dir,
+            file_name=file_name,
+            metadata=dropbox.files.PhotoMetadata(
+                dimensions=dropbox.files.Dimensions(size, size)
+            ),
+            transfers=transfers,
+        )
+    transfers.flush()
+    uploads, review, backup, error = _get_folder_contents(root_dir)
+    assert error == [], "No error during processing"
+    assert uploads == []
+    assert len(list((root_dir / "Review").rglob("*worse*"))) == 0
+    assert len(list((root_dir / "Review").rglob("*better*"))) == 1
+    assert len(list((root_dir / "Backup").rglob("*worse*"))) == 1
+    assert len(list((root_dir / "Backup").rglob("*better*"))) == 1
+
+
 @pytest.mark.parametrize("extension", config.image_extensions)
 @pytest.mark.parametrize("process_img", [True, False])
 def test_duplicate_better(tmpdir, extension, monkeypatch, process_img) -> None:
@@ -440,14 +874,82 @@ def test_duplicate_better(tmpdir, extension, monkeypatch, process_img) -> None:
     assert len(backup) == 4
 
 
+def test_claim_hash(monkeypatch) -> None:
+    fake_redis_client = fakeredis.FakeStrictRedis()
+    account_id = "test_claim_hash"
+    stored_hash = "ff00ff00ff00ff00"
+    assert claim_hash(account_id, stored_hash, Path("a.jpg"), fake_redis_client) is None
+    assert claim_hash(account_id, stored_hash, Path("b.jpg"), fake_redis_client) == (
+        stored_hash,
+        "a.jpg",
+    )
+    near_hash = "ff00ff00ff00ff03"
+    assert claim_hash(account_id, near_hash, Path("c.jpg"), fake_redis_client) == (
+        stored_hash,
+        "b.jpg",
+    )
+    far_hash = "00ff00ff00ff00ff"
+    assert claim_hash(account_id, far_hash, Path("d.jpg"), fake_redis_client) is None
+    delete_hash(account_id, stored_hash, fake_redis_client)
+    delete_hash(account_id, near_hash, fake_redis_client)
+    assert claim_hash(account_id, near_hash, Path("e.jpg"), fake_redis_client) is None
+    assert fake_redis_client.ttl(f"user:{account_id}, hash:{near_hash}") > 0
+    # shares a chunk, but one bit over the limit
+    monkeypatch.setattr("kamera.task.config.duplicate_hash_distance", 4)
+    zero_hash = "0000000000000000"
+    assert claim_hash(account_id, zero_hash, Path("f.jpg"), fake_redis_client) is None
+    over_hash = "000000000000001f"
+    assert claim_hash(account_id, over_hash, Path("g.jpg"), fake_redis_client) is None
+
+
+def test_claim_hash_expired() -> None:
+    fake_redis_client = fakeredis.FakeStrictRedis()
+    account_id = "test_claim_hash_expired"
+    stored_hash = "ff00ff00ff00ff00"
+    claim_hash(account_id, stored_hash, Path("a.jpg"), fake_redis_client)
+    # expired, while its chunk sets were kept by other members
+    fake_redis_client.delete(f"user:{account_id}, hash:{stored_hash}")
+    near_hash = "ff00ff00ff00ff03"
+    assert claim_hash(account_id, near_hash, Path("b.jpg"), fake_redis_client) is None
+    for chunk_key in hash_chunk_keys(account_id, near_hash):
+        assert not fake_redis_client.sismember(chunk_key, stored_hash)
+
+
+def test_near_duplicate_worse(tmpdir, monkeypatch) -> None:
+    root_dir = Path(tmpdir)
+    make_all_temp_folders(root_dir)
+    img_hashes = iter(["ff00ff00ff00ff00", "ff00ff00ff00ff01"])
+
+    def process_img_mock(*args, **kwargs):
+        return image_processing.ProcessedImage(data=None, img_hash=next(img_hashes))
+
+    monkeypatch.setattr("kamera.task.image_processing.main", process_img_mock)
+    for file_name, size in [("worse", 100), ("better", 150)]:
+        metadata = dropbox.files.PhotoMetadata(
+            dimensions=dropbox.files.Dimensions(size, size)
+        )
+        run_task_process_entry(
+            test_name="test_near_duplicate_worse",
+            ext=".jpg",
+            root_dir=root_dir,
+            file_name=file_name,
+            metadata=metadata,
+        )
+    uploads, review, backup, error = _get_folder_contents(root_dir)
+    assert error == [], "No error during processing"
+    assert len(list((root_dir / "Review").rglob("*worse*"))) == 0
+    assert len(list((root_dir / "Review").rglob("*better*"))) == 1
+
+
 def monkeypatch_img_processing(monkeypatch, return_new_data: bool) -> None:
-    def no_img_processing_mock(*args, **kwargs):
-        new_data = None
-        return new_data
+    def no_img_processing_mock(data, *args, **kwargs):
+        img_hash = image_processing.get_hash(Image.open(BytesIO(data)))
+        return image_processing.ProcessedImage(data=None, img_hash=img_hash)
 
     def process_img_mock(dimensions, *args, **kwargs):
         new_data = make_image(dimensions=dimensions, changed=True)
-        return new_data
+        img_hash = image_processing.get_hash(Image.open(BytesIO(new_data)))
+        return image_processing.ProcessedImage(data=new_data, img_hash=img_hash)
 
     if return_new_data is True:
         monkeypatch.setattr("kamera.task.image_processing.main", process_img_mock)
@@ -467,6 +969,7 @@ class MockSettings(config.Settings):
     "Subclasses settings but overrides only method, to satisfy mypy"
 
     def __init__(self, account_id):
+        self.checked_at = time.monotonic()
         self.default_tz: str = "US/Eastern"
         self.folder_names: t.Dict[str, str] = {
             1: "January",
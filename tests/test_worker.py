@@ -0,0 +1,32 @@
+#! /usr/bin/env python3
+# coding: utf-8
+import fakeredis
+import rq
+
+from kamera.worker import RecyclingWorker
+
+
+def job() -> str:
+    return "done"
+
+
+def test_worker_stops_after_max_jobs() -> None:
+    redis_client = fakeredis.FakeStrictRedis()
+    queue = rq.Queue(connection=redis_client)
+    for _ in range(3):
+        queue.enqueue(job, result_ttl=0)
+    worker = RecyclingWorker([queue], connection=redis_client, max_jobs=2)
+    worker.work(burst=True)
+    assert worker.jobs_executed == 2
+    assert queue.count == 1
+
+
+def test_worker_stops_over_memory_limit() -> None:
+    redis_client = fakeredis.FakeStrictRedis()
+    queue = rq.Queue(connection=redis_client)
+    for _ in range(2):
+        queue.enqueue(job, result_ttl=0)
+    worker = RecyclingWorker([queue], connection=redis_client, max_memory_mb=1)
+    worker.work(burst=True)
+    assert worker.jobs_executed == 1
+    assert queue.count == 1
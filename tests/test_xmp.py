@@ -0,0 +1,45 @@
+#! /usr/bin/env python3
+# coding: utf-8
+import typing as t
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from kamera import xmp
+
+test_images_path = Path.cwd() / "tests" / "test_images"
+
+
+def _get_subjects(data: bytes) -> t.List[t.Optional[str]]:
+    segments, _ = xmp._split_segments(data)
+    (segment,) = [
+        segment
+        for marker, segment in segments
+        if marker == xmp.APP1 and segment[4:].startswith(xmp.XMP_HEADER)
+    ]
+    xmpmeta = xmp._parse_packet(segment)
+    return [li.text for li in xmpmeta.iterfind(".//dc:subject//rdf:li", xmp.namespaces)]
+
+
+def test_add_subjects_new_packet() -> None:
+    with open(test_images_path / "input" / "spot.jpg", "rb") as file:
+        data = file.read()
+    output = xmp.add_subjects(data, ["Paris/Place de la Concorde", "Obama & Biden"])
+    assert _get_subjects(output) == ["Paris/Place de la Concorde", "Obama & Biden"]
+    Image.open(BytesIO(output)).load()
+
+
+def test_add_subjects_merge_existing() -> None:
+    with open(test_images_path / "desired_output" / "spot.jpg", "rb") as file:
+        data = file.read()
+    output = xmp.add_subjects(data, ["Paris/Place de la Concorde", "Obama"])
+    assert _get_subjects(output) == ["Paris/Place de la Concorde", "Obama"]
+
+
+def test_add_subjects_not_jpeg() -> None:
+    with open(test_images_path / "input" / "filetype.png", "rb") as file:
+        data = file.read()
+    with pytest.raises(xmp.XMPError):
+        xmp.add_subjects(data, ["Paris"])